@@ -0,0 +1,62 @@
+__author__ = 'Jayson Stemmler'
+__created__ = "10/18/26 5:20 PM"
+
+import os
+
+import numpy as np
+import pandas as pd
+from netCDF4 import Dataset
+
+from toolbox.fileIO.netCDF import NetCDFFolder
+
+
+def _write_folder(folder, days=(15, 16, 18), n=1440):
+    """Daily ARM-style files of 1-minute data, with a missing day"""
+
+    for day in days:
+        path = os.path.join(folder, 'testC1.a1.201403{:02d}.000006.cdf'.format(day))
+        with Dataset(path, 'w') as D:
+            D.createDimension('time', None)
+            t = D.createVariable('time', 'f8', ('time',))
+            t.units = 'seconds since 2014-03-{:02d} 00:00:06 0:00'.format(day)
+            t[:] = np.arange(n) * 60.
+            x = D.createVariable('concentration', 'f4', ('time',))
+            x.units = 'cm-3'
+            x[:] = np.arange(n) % 97 + day
+
+    return folder
+
+
+def _check(lazy, full, rule, how):
+
+    expected = getattr(full.resample(rule), how)()
+    result = lazy.resample(rule, how=how)
+
+    assert result.index.equals(expected.index)
+    assert np.allclose(result.values.astype(float), expected.values.astype(float),
+                       equal_nan=True)
+
+
+def test_lazy_resample_matches_process(tmpdir):
+    # rules that don't divide a day only line up across files if every
+    # file is binned from the same origin
+    folder = NetCDFFolder(_write_folder(str(tmpdir)))
+
+    lazy = folder.open_lazy('concentration')
+    full = folder.process('concentration')
+
+    for rule in ('7h', '5h', '2D', '6h'):
+        for how in ('mean', 'sum', 'count', 'max'):
+            _check(lazy, full, rule, how)
+
+
+def test_lazy_resample_window(tmpdir):
+    folder = NetCDFFolder(_write_folder(str(tmpdir)))
+
+    start, end = pd.Timestamp('2014-03-15 13:00'), pd.Timestamp('2014-03-18 05:00')
+
+    lazy = folder.open_lazy('concentration').between(start, end)
+    full = folder.process('concentration').loc[start:end]
+
+    for how in ('mean', 'count'):
+        _check(lazy, full, '7h', how)
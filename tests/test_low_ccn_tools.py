@@ -0,0 +1,68 @@
+__author__ = 'Jayson Stemmler'
+__created__ = "10/18/26 3:10 PM"
+
+import numpy as np
+import pandas as pd
+
+from toolbox.low_ccn_tools import CCNPartition, LowCCNMonitor, low_ccn_sweep
+
+
+def _ccn_data(ss_dtype):
+    """Two days of 1-minute CCN data cycling through three setpoints"""
+
+    index = pd.date_range('2014-03-15', periods=2880, freq='min')
+    ss = np.tile(np.array([0.1, 0.2, 0.5], dtype=ss_dtype), 960)
+    ccn = np.linspace(5., 60., len(index))
+
+    return pd.DataFrame({'CCN': ccn, 'SS': ss}, index=index)
+
+
+def test_partition_float32_ss():
+    # ARM CCN files store SS as float32, so the stored 0.1 is not the
+    # float64 0.1 a user passes in
+    df = _ccn_data(np.float32)
+    partition = CCNPartition(df)
+
+    assert 0.1 in partition
+    assert 0.3 not in partition
+    for setpoint in (0.1, 0.2, 0.5):
+        expected = df['CCN'][df['SS'] == setpoint]
+        assert len(expected) == 960
+        assert partition.get(setpoint).equals(expected)
+
+    stats = partition.stats()
+    assert stats['count'].tolist() == [960, 960, 960]
+
+
+def test_sweep_float32_ss():
+    df32 = _ccn_data(np.float32)
+    df64 = _ccn_data(np.float64)
+
+    r32 = low_ccn_sweep(df32, [20, 40], intervals=['6h'], supersaturations=[0.1, 0.5])
+    r64 = low_ccn_sweep(df64, [20, 40], intervals=['6h'], supersaturations=[0.1, 0.5])
+
+    assert len(r32)
+    assert np.array_equal(r32.values, r64.values)
+
+
+def test_monitor_float32_ss():
+    df = _ccn_data(np.float32)
+    events = []
+
+    monitor = LowCCNMonitor(threshold=40, interval='6h', supersaturation=0.1,
+                            callback=events.append)
+    for i in range(0, len(df), 500):
+        monitor.update(df.iloc[i:i + 500])
+    monitor.flush()
+
+    assert len(events)
+
+
+def test_sweep_partition_matches_scan():
+    df = _ccn_data(np.float32)
+
+    scanned = low_ccn_sweep(df, [20, 40], intervals=['6h', '7h'], supersaturations=[0.1, 0.2])
+    looked_up = low_ccn_sweep(CCNPartition(df), [20, 40], intervals=['6h', '7h'],
+                              supersaturations=[0.1, 0.2])
+
+    assert scanned.equals(looked_up)
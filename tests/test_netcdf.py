@@ -0,0 +1,59 @@
+__author__ = 'Jayson Stemmler'
+__created__ = "10/18/26 3:40 PM"
+
+import os
+
+import numpy as np
+from netCDF4 import Dataset
+
+from toolbox.fileIO import netCDF
+
+
+def _write_file(path, day, n=60):
+
+    with Dataset(path, 'w') as D:
+        D.createDimension('time', None)
+        t = D.createVariable('time', 'f8', ('time',))
+        t.units = 'seconds since 2014-03-{:02d} 00:00:00 0:00'.format(day)
+        t[:] = np.arange(n) * 60.
+        x = D.createVariable('concentration', 'f4', ('time',))
+        x.units = 'cm-3'
+        x[:] = np.arange(n) + day
+
+    return path
+
+
+def test_dataset_cache_keeps_open_handles(tmpdir, monkeypatch):
+    # fewer cache slots than files open at the same time
+    monkeypatch.setattr(netCDF, 'dataset_cache', netCDF.DatasetCache(maxsize=1))
+
+    files = [_write_file(os.path.join(str(tmpdir), 'test.{}.nc'.format(day)), day)
+             for day in (15, 16, 17)]
+    ncs = [netCDF.NetCDFFile(f, cache=True) for f in files]
+
+    for nc in ncs:
+        nc.open()
+
+    # each of these evicts the handles of the others from the cache
+    for day, nc in zip((15, 16, 17), ncs):
+        df = nc.get_vars('concentration')
+        assert df['concentration'].iloc[0] == day
+
+    handles = [nc._handle for nc in ncs]
+    for nc in ncs:
+        nc.close()
+
+    # once released, only 'maxsize' handles are left open
+    assert sum(D.isopen() for D in handles) == 1
+
+
+def test_dataset_cache_reuses_handle(tmpdir, monkeypatch):
+    monkeypatch.setattr(netCDF, 'dataset_cache', netCDF.DatasetCache(maxsize=2))
+
+    f = _write_file(os.path.join(str(tmpdir), 'test.15.nc'), 15)
+
+    with netCDF.NetCDFFile(f, cache=True) as a:
+        with netCDF.NetCDFFile(f, cache=True) as b:
+            assert a._handle is b._handle
+        assert a._handle.isopen()
+        assert len(a.get_vars('concentration')) == 60
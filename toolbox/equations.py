@@ -5,7 +5,153 @@ __created__ = "6/5/15 7:52 AM"
     EQUATIONS
 """
 
-def qsatw(t, p):
+import numpy as np
+import pandas as pd
+from functools import partial
+
+from .tools import pmap
+
+# physical constants
+T0 = 273.16         # triple point of water, K
+G = 9.81            # gravity, m/s2
+R_D = 287.04        # gas constant for dry air, J/kg/K
+L_V = 2.5e6         # latent heat of vaporization, J/kg
+CP = 1004.67        # specific heat of dry air, J/kg/K
+EPS = 0.622         # R_D / R_V
+
+_LN10 = np.log(10.)
+
+# constants for the moist adiabatic condensate gradient in adlwcgm2
+_C_NUM = G / R_D
+_C_CP = L_V * EPS / CP
+_C_DEN = EPS * L_V * L_V / (R_D * CP)
+_C_RHO = 100. * 1000. / R_D
+
+# number of elements evaluated at a time, small enough that the scratch
+# arrays stay in cache instead of allocating full-size temporaries
+_BLOCK = 16384
+
+
+def _is_wrapped(x):
+    """True for pandas and xarray objects, which are returned as such
+
+    Anything else (scalars, lists, tuples, arrays) goes through np.asarray.
+    """
+    return isinstance(x, (pd.Series, pd.DataFrame)) or hasattr(x, 'dims')
+
+
+def _wrap_like(like, values):
+    """Put values back into the pandas/xarray container of like, if any"""
+
+    if np.ndim(values) == 0:
+        return float(values)
+
+    for x in like:
+        if not _is_wrapped(x) or np.shape(x) != np.shape(values):
+            continue
+        if hasattr(x, 'dims'):
+            return x.copy(data=values)
+        if isinstance(x, pd.DataFrame):
+            return x.__class__(values, index=x.index, columns=x.columns)
+        return x.__class__(values, index=x.index, name=x.name)
+
+    return values
+
+
+def _evaluate(kernel, args, out=None, dtype=None, nscratch=0):
+    """Evaluate kernel over the broadcast args, one block at a time
+
+    kernel is called as kernel(*arg_blocks, out_block, *scratch) on 1-D
+    blocks of at most _BLOCK elements, in dtype (default float64). The
+    result is written to 'out' if given, and is otherwise returned in the
+    same container as the args (float, array, pandas, or xarray).
+    """
+
+    dtype = np.dtype(np.float64 if dtype is None else dtype)
+    arrays = [np.asarray(a) for a in args]
+
+    it = np.nditer(arrays + [out],
+                   flags=['external_loop', 'buffered', 'zerosize_ok'],
+                   op_flags=[['readonly']] * len(arrays) + [['writeonly', 'allocate', 'no_broadcast']],
+                   op_dtypes=[dtype] * (len(arrays) + 1),
+                   casting='same_kind', buffersize=_BLOCK)
+
+    scratch = [np.empty(_BLOCK, dtype) for i in range(nscratch)]
+
+    for blocks in it:
+        n = len(blocks[0])
+        kernel(*(list(blocks) + [s[:n] for s in scratch]))
+
+    res = it.operands[-1]
+
+    if out is not None:
+        return out
+
+    return _wrap_like(args, res)
+
+
+def _qsatw_kernel(t, p, res, a, b):
+
+    # log10(esw) = 10.79574 (1 - t0/t) - 5.028 log10(t/t0)
+    #              + 1.50475e-4 (1 - 10**(-8.2369 (t/t0 - 1)))
+    #              + 0.42873e-3 (10**(4.76955 (1 - t0/t)) - 1) + 2.78614
+    np.divide(T0, t, out=a)
+    np.log10(a, out=b)
+    np.multiply(b, 5.028, out=res)
+    res += 2.78614 + 1.50475e-4 - 0.42873e-3
+
+    np.subtract(1., a, out=a)           # 1 - t0/t
+    np.multiply(a, 10.79574, out=b)
+    res += b
+
+    np.multiply(t, 1. / T0, out=b)      # t/t0 - 1
+    b -= 1.
+    b *= -8.2369 * _LN10
+    np.exp(b, out=b)
+    b *= 1.50475e-4
+    res -= b
+
+    np.multiply(a, 4.76955 * _LN10, out=b)
+    np.exp(b, out=b)
+    b *= 0.42873e-3
+    res += b
+
+    # esw = 10**log10esw, qsw = 0.62198 esw / (p - esw)
+    res *= _LN10
+    np.exp(res, out=res)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        np.subtract(p, res, out=a)
+        np.divide(res, a, out=res)
+    res *= 0.62198
+
+    res[np.isinf(res)] = 0.
+
+
+def _adlwcgm2_kernel(t, p, res, a, b, c, scale=_C_NUM * _C_RHO):
+
+    np.multiply(p, 100., out=c)
+    _qsatw_kernel(t, c, res, a, b)      # res = qs
+
+    #;dqldz = (g qs / (R t)) (L eps / (cp t) - 1) / (1 + eps L L qs / (R t t cp))
+    #;        * rho * 1000, with rho = 100 p / (R t)
+    np.divide(1., t, out=a)
+    np.multiply(res, a, out=b)
+    b *= a
+    b *= _C_DEN
+    b += 1.
+    res /= b
+
+    np.multiply(a, _C_CP, out=b)
+    b -= 1.
+    res *= b
+    res *= a
+    res *= a
+    res *= p
+    res *= scale
+
+
+def qsatw(t, p, out=None, dtype=None):
     """saturated vapor pressure with respect to water.
     use functions given in Unified Model Documentation No. 29
     Calculation of saturated specific humidity and large scale cloud.
@@ -15,57 +161,259 @@ def qsatw(t, p):
     t is temperature in K
     p is pressure in Pa
     qsw is the saturated specific humidity wrt water in Pa
+
+    t and p can be scalars, N-D arrays, or pandas/xarray objects, and are
+    broadcast against each other. Pass 'out' to write the result into an
+    existing array, and dtype=np.float32 to do the math in single
+    precision (default is float64).
     """
 
-    t0=273.16
-    t = array(t); p = array(p)
-    log10esw=10.79574 * (1-t0/t) - 5.028 * log10(t/t0) + \
-             1.50475e-4 * (1-10**(-8.2369*(t/t0-1))) + 0.42873e-3 * \
-             (10**(4.76955*(1-t0/t))-1) + 2.78614
+    return _evaluate(_qsatw_kernel, (t, p), out=out, dtype=dtype, nscratch=2)
 
-    esw=10**(log10esw)
-    qsw=0.62198*esw/(p-esw)
+def adlwcgm2(t, p, out=None, dtype=None):
 
-    try:
-        qsw[isinf(qsw)] = 0.
-    except TypeError:
-        if isinf(qsw):
-            qsw = 0.
+    """ takes in temperature in k
+    pressure in hPa
 
-    return qsw
+    returns the adiabatic liquid water content gradient in g/m3 per m.
+    Takes the same 'out' and 'dtype' arguments as qsatw.
+    """
 
-def adlwcgm2(t, p):
+    return _evaluate(_adlwcgm2_kernel, (t, p), out=out, dtype=dtype, nscratch=3)
 
-    """ takes in temperature in k
-    pressure in hPa
+# (T, p) lookup table for gam_ad(lookup=True): temperature in K and
+# pressure in hPa as (min, max, step). Bilinear interpolation on this grid
+# is within a relative error of 1e-4 of the full calculation (7.3e-5 worst
+# case over the whole grid); the error is set by the temperature step.
+GAM_AD_TABLE_T = (220., 320., 0.25)
+GAM_AD_TABLE_P = (300., 1100., 5.)
+
+_gam_ad_kernel = partial(_adlwcgm2_kernel, scale=1.e-3 * _C_NUM * _C_RHO)
+_gam_ad_table = None
+
+
+def _get_gam_ad_table():
+    """Build the gam_ad lookup table the first time it is needed
+
+    The last row and column are repeated once, so that points sitting
+    exactly on the upper edge of the table still have a cell to the
+    upper right of them.
     """
 
-    qs = qsatw(t, 100.*p)
+    global _gam_ad_table
 
-    rho=100.0*p/(287.04*t)
+    if _gam_ad_table is None:
+        t = np.arange(GAM_AD_TABLE_T[0], GAM_AD_TABLE_T[1] + GAM_AD_TABLE_T[2] / 2, GAM_AD_TABLE_T[2])
+        p = np.arange(GAM_AD_TABLE_P[0], GAM_AD_TABLE_P[1] + GAM_AD_TABLE_P[2] / 2, GAM_AD_TABLE_P[2])
+        t = np.append(t, t[-1])
+        p = np.append(p, p[-1])
+        _gam_ad_table = gam_ad(t[:, np.newaxis], p[np.newaxis, :])
 
-    g=9.81
-    R=287.04
-    L=2.5e6
-    cp=1004.67
+    return _gam_ad_table
 
-    eps=0.622
 
-    #;gam in g/kg per metre
+def _gam_ad_lookup_kernel(t, p, res, fi, fj):
+    """Bilinear interpolation of gam_ad from the lookup table
 
-    #;gam in g/m3/m
+    Points outside of the table are calculated in full.
+    """
+
+    table = _get_gam_ad_table()
+    nt, np_ = table.shape
+    flat = table.ravel()
+
+    np.subtract(t, GAM_AD_TABLE_T[0], out=fi)
+    fi *= 1. / GAM_AD_TABLE_T[2]
+    np.subtract(p, GAM_AD_TABLE_P[0], out=fj)
+    fj *= 1. / GAM_AD_TABLE_P[2]
+
+    # the full mask is only needed if something is off the table (or NaN)
+    outside = None
+    if not (fi.min() >= 0 and fi.max() <= nt - 2 and fj.min() >= 0 and fj.max() <= np_ - 2):
+        outside = ~((fi >= 0) & (fi <= nt - 2) & (fj >= 0) & (fj <= np_ - 2))
+        fi[outside] = 0.
+        fj[outside] = 0.
+
+    i = fi.astype(np.intp)
+    j = fj.astype(np.intp)
+    fi -= i
+    fj -= j
+
+    # flat index of the lower left corner of each cell
+    k = i
+    k *= np_
+    k += j
+
+    lower = flat.take(k)
+    upper = flat.take(k + 1)
+    k += np_
+    np.subtract(flat.take(k), lower, out=res)
+    res *= fi
+    lower += res
+    np.subtract(flat.take(k + 1), upper, out=res)
+    res *= fi
+    upper += res
+
+    np.subtract(upper, lower, out=res)
+    res *= fj
+    res += lower
+
+    if outside is not None:
+        res[outside] = gam_ad(t[outside], p[outside])
+
+def gam_ad(t, p=900., out=None, dtype=None, lookup=False):
+    """adiabatic liquid water content gradient in kg/m3 per m
+
+    t in K, p in hPa. With lookup=True the value is interpolated from a
+    precomputed (T, p) table instead (see GAM_AD_TABLE_T/P for the range
+    and error bound), which skips the saturation vapor pressure math for
+    large arrays of boundary layer temperatures and pressures. How much
+    that buys depends on the NumPy build: where exp/log10 are vectorized
+    the full calculation is already about as fast as the table.
+    """
 
+    if lookup:
+        return _evaluate(_gam_ad_lookup_kernel, (t, p), out=out, dtype=dtype, nscratch=2)
 
-    dqldz=(g*qs/(R*t))*(L*eps/(cp*t)-1.0)/(1+eps*L*L*qs/(R*t*t*cp))
-    dqldz=rho*dqldz*1000.
+    return _evaluate(_gam_ad_kernel, (t, p), out=out, dtype=dtype, nscratch=3)
 
-    #;dqldz in g/m3 per m
+# B**3 in the Nd retrieval, B = (3 sqrt(2) / (4 pi rho_w))**(1/3)
+_ND_B3 = 3. * np.sqrt(2.) / (4. * np.pi * 1000.)
 
-    return dqldz
 
-def gam_ad(t, p=900.):
+def _nd_kernel(lwp, re, gam, frac, res, k):
+
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+
+        # k_martin = 0.865 - exp(-0.3 re), re in um
+        np.multiply(re, -0.30e6, out=k)
+        np.exp(k, out=k)
+        np.subtract(0.865, k, out=k)
+        k[np.isinf(k)] = 0.8
+        k[re < 3.e-6] = 0.45
+
+        # nd = B**3 (k_ad / re)**3 sqrt(lwp) / k_martin, k_ad**3 = sqrt(frac gam)
+        np.multiply(frac, gam, out=res)
+        res *= lwp
+        np.sqrt(res, out=res)
+        res /= k
+
+        np.multiply(re, re, out=k)
+        k *= re
+        res /= k
+        res *= _ND_B3
+
+    res[(lwp == 0) | (re == 0)] = np.nan
+
+
+def retrieve_nd(lwp, re, gam_ad=2.e-6, frac_ad=1., out=None, dtype=None):
+    """Droplet number concentration from LWP and Re, for whole granules
+
+    Computes k_martin, the adiabatic factor and Nd in one pass over the
+    data, one block at a time, so arrays of any size and shape can be fed
+    in without building a pile of full-size temporaries.
+
+    Arguments
+    ---------------------
+
+        Required:
+
+        -   lwp (array)
+                liquid water path in kg per m**2 (g/m2 * 1e-3)
+
+        -   re (array)
+                effective radius in meters (um * 1e-6)
+
+        Optional:
+
+        -   gam_ad (float or array)
+                adiabatic condensate gradient, order 2e-6 (see gam_ad)
+
+        -   frac_ad (float or array)
+                adiabatic fraction, unitless, ~1.0
+
+        -   out, dtype
+                same as for qsatw
+
+    All of the arguments are broadcast against each other. Pixels where
+    lwp or re is zero, NaN or masked come out as NaN. If lwp or re is a
+    masked array the result is masked there too.
+    """
+
+    masked = isinstance(lwp, np.ma.MaskedArray) or isinstance(re, np.ma.MaskedArray)
+
+    args = []
+    for x in (lwp, re, gam_ad, frac_ad):
+        if isinstance(x, np.ma.MaskedArray):
+            x = x.astype(np.float64).filled(np.nan)
+        args.append(x)
+
+    nd = _evaluate(_nd_kernel, args, out=out, dtype=dtype, nscratch=1)
+
+    if masked and out is None:
+        return np.ma.masked_invalid(nd, copy=False)
+
+    return nd
+
+
+def _retrieve_granule(args):
+
+    granule, reader, gam_ad, frac_ad, dtype = args
+
+    if reader is not None:
+        granule = reader(granule)
+
+    if len(granule) == 2:
+        lwp, re = granule
+    else:
+        lwp, re, gam_ad = granule
+
+    return retrieve_nd(lwp, re, gam_ad=gam_ad, frac_ad=frac_ad, dtype=dtype)
+
+
+def iter_nd(granules, reader=None, gam_ad=2.e-6, frac_ad=1., dtype=None,
+            workers=None, executor=None):
+    """Run retrieve_nd over a stream of granules, yielding Nd for each
+
+    Only the granules being worked on are held in memory, so this can run
+    over a whole folder of satellite files.
+
+    Arguments
+    ---------------------
+
+        Required:
+
+        -   granules (iterable)
+                (lwp, re) or (lwp, re, gam_ad) tuples of arrays, or, if
+                reader is given, anything reader knows how to open, e.g.
+                a list of file names
+
+        Optional:
+
+        -   reader (function)
+                called on each item of granules to get the (lwp, re) or
+                (lwp, re, gam_ad) arrays. It runs in the worker, so with a
+                process pool only the file name goes over to the worker.
+                Must be defined at module level unless executor='thread'.
+
+        -   gam_ad, frac_ad, dtype
+                as in retrieve_nd. gam_ad is used for granules that don't
+                come with their own.
+
+        -   workers, executor
+                see toolbox.tools.pmap. Results come back in the same order
+                as granules either way.
+
+    Example:
+
+        for f, nd in zip(files, iter_nd(files, reader=read_lwp_re, workers=4)):
+            ...
+    """
+
+    tasks = ((g, reader, gam_ad, frac_ad, dtype) for g in granules)
+
+    return pmap(_retrieve_granule, tasks, workers=workers, executor=executor)
 
-    return 1.e-3*adlwcgm2(t, p)
 
 def get_nd_from_lwp_re(gam_ad, frac_ad, lwp, re):
 
@@ -83,39 +431,12 @@ def get_nd_from_lwp_re(gam_ad, frac_ad, lwp, re):
     :param: frac_ad
     :units: unitless, ~1.0
 
+    Returns NaN where lwp or re is zero. See retrieve_nd for the batched
+    version, which also broadcasts and handles masked arrays.
     """
 
     # check that LWP and re are same length
-    if type(lwp) != type(re):
-        raise Exception('LWP and re are not the same type')
-
-    if type(lwp) != 'numpy.ndarray':
-        lwp = array(lwp)
-    if type(re) != 'numpy.ndarray':
-        re = array(re)
-
-    if lwp.shape != re.shape:
+    if np.shape(lwp) != np.shape(re):
         raise Exception('LWP and re not the same length')
 
-    B = (3.*sqrt(2.) / (4.*pi*1000.))**(1./3.)
-    k_ad = (frac_ad * gam_ad)**(1./6.)
-
-    k_martin = array(0.865-exp(-0.30*re*1.e6))
-
-    if not len(k_martin.shape):
-        if isinf(k_martin): k_martin = 0.8
-        if re < 3.e-6: k_martin = 0.45
-    else:
-        k_martin[isinf(k_martin)] = 0.8
-        k_martin[re < 3.e-6] = 0.45
-
-    nd = (B**3.) * ((k_ad / re)**3.) * sqrt(lwp)/k_martin
-
-    if len(lwp.shape)==0:
-        if (lwp==0) | (re==0):
-            return None
-    elif len(lwp.shape) > 0:
-        nd[(lwp==0) | (re==0)] = None
-        return nd
-
-    return nd
\ No newline at end of file
+    return retrieve_nd(lwp, re, gam_ad=gam_ad, frac_ad=frac_ad)
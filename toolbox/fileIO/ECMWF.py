@@ -1,62 +1,526 @@
 __author__ = 'Jayson Stemmler'
 __created__ = "6/9/15 11:20 AM"
 
+import os
+import hashlib
+import warnings
+
 import numpy as np
-from netCDF4 import Dataset, num2date
+import pandas as pd
+from netCDF4 import Dataset
+
+from ..tools import pmap
+from .times import decode_times
+
+# upper limit on the number of grid values pulled from a file in one read,
+# the times are split into several reads beyond this
+_MAX_READ = 2**24
+
+
+def _axis_index(axis, x, method='nearest', cyclic=False):
+    """Fractional positions of x on a 1-D coordinate axis
+
+    Returns (index, weight) arrays of shape (len(x), 1) for 'nearest' or
+    (len(x), 2) for 'bilinear', with -1 as the index of points that are
+    off the axis. The axis may be ascending or descending. With cyclic=True
+    (longitude) x is taken modulo 360 onto the axis, and axes that go all
+    the way around the globe wrap.
+    """
+
+    axis = np.asarray(axis, dtype=float)
+    x = np.asarray(x, dtype=float)
+    n = len(axis)
+
+    pos = np.arange(n, dtype=float)
+    if axis[0] > axis[-1]:
+        axis, pos = axis[::-1], pos[::-1]
+
+    step = (axis[-1] - axis[0]) / max(n - 1, 1)
+    periodic = cyclic and n > 1 and axis[-1] - axis[0] + 1.5 * step >= 360.
+
+    if cyclic:
+        x = axis[0] + np.mod(x - axis[0], 360.)
+
+    if periodic:
+        # add the cell that wraps around
+        axis = np.append(axis, axis[0] + 360.)
+        pos = np.append(pos, 2 * pos[-1] - pos[-2])
+
+    f = np.interp(x, axis, pos, left=np.nan, right=np.nan)
+    bad = np.isnan(f)
+    f[bad] = 0.
+
+    if method == 'nearest':
+        index = np.round(f).astype(np.intp)[:, np.newaxis]
+        weight = np.ones(index.shape)
+    elif method == 'bilinear':
+        lower = np.floor(f)
+        index = np.column_stack([lower, lower + 1]).astype(np.intp)
+        weight = np.column_stack([1. - (f - lower), f - lower])
+        if not periodic:
+            # points right on the last grid line
+            edge = index[:, 1] >= n
+            index[edge, 1] = n - 1
+    else:
+        raise ValueError("method must be 'nearest' or 'bilinear'")
+
+    if periodic:
+        index %= n
+
+    index[bad] = -1
+
+    return index, weight
+
+
+def _read_points(var, ti, yi, yw, xi, xw):
+    """Read var[ti, yi, xi] at a set of points and combine the neighbours
+
+    ti is (npts,), yi/yw and xi/xw are the (npts, k) arrays from
+    _axis_index. Points are grouped by time, and each group of times is
+    read as one block covering only the lat/lon box around its points,
+    with as many times per block as fit under _MAX_READ values. A single
+    site or a ship track usually comes out of one read.
+    """
+
+    out = np.full(len(ti), np.nan)
+
+    good = np.nonzero((ti >= 0) & (yi >= 0).all(axis=1) & (xi >= 0).all(axis=1))[0]
+    if not len(good):
+        return out
+
+    good = good[np.argsort(ti[good], kind='mergesort')]
+    t_u, first = np.unique(ti[good], return_index=True)
+    bounds = np.append(first, len(good))
+
+    y_lo = np.minimum.reduceat(yi[good].min(axis=1), first)
+    y_hi = np.maximum.reduceat(yi[good].max(axis=1), first)
+    x_lo = np.minimum.reduceat(xi[good].min(axis=1), first)
+    x_hi = np.maximum.reduceat(xi[good].max(axis=1), first)
+
+    def read(a, b, y0, y1, x0, x1):
+
+        times = t_u[a:b]
+        if times[-1] - times[0] == b - a - 1:
+            times = slice(times[0], times[-1] + 1)
+
+        # netCDF4 reads an index list one element at a time, but a slice
+        # in one go, so the lat/lon box is always read as slices
+        block = var[times, y0:y1 + 1, x0:x1 + 1]
+        block = np.ma.filled(np.ma.asarray(block, dtype=float), np.nan)
+
+        pts = good[bounds[a]:bounds[b]]
+        t_at = np.repeat(np.arange(b - a), np.diff(bounds[a:b + 1]))
+
+        values = np.zeros(len(pts))
+        for k in range(yi.shape[1]):
+            for m in range(xi.shape[1]):
+                values += (yw[pts, k] * xw[pts, m] *
+                           block[t_at, yi[pts, k] - y0, xi[pts, m] - x0])
+
+        out[pts] = values
+
+    start = 0
+    box = None
+    for k in range(len(t_u)):
+        grown = (min(y_lo[k], box[0]), max(y_hi[k], box[1]),
+                 min(x_lo[k], box[2]), max(x_hi[k], box[3])) if box else \
+                (y_lo[k], y_hi[k], x_lo[k], x_hi[k])
+        size = (k - start + 1) * (grown[1] - grown[0] + 1) * (grown[3] - grown[2] + 1)
+
+        if box and size > _MAX_READ:
+            read(start, k, *box)
+            start = k
+            box = (y_lo[k], y_hi[k], x_lo[k], x_hi[k])
+        else:
+            box = grown
+
+    read(start, len(t_u), *box)
+
+    return out
 
-def pick_ecmwf_point(f, v, at=None, LAT=None, LON=None):
 
-    at_times = np.array(at, ndmin=1)
-    vout = np.zeros_like(at_times, dtype=float) * np.nan
+def pick_ecmwf_point(f, v, at=None, LAT=None, LON=None, method='nearest', cache=None):
+    """Pull values of an ECMWF variable out at points in time and space
 
-    def shiftlon(l):
-        if 0 <= l <= 180:
-            return l
-        elif -180 <= l < 0:
-            return l + 360.
+    Arguments
+    ---------------------
+
+        Required:
+
+        -   f (str): ECMWF netCDF file
+
+        -   v (str): variable name, e.g. 't2m'
+
+        Optional:
+
+        -   at (datetime-like or array)
+                times to pick out. Only times that are on the file's time
+                axis are picked, the rest come back as NaN. Default is
+                every time in the file.
+
+        -   LAT, LON (float or array)
+                a single point (e.g. a site), or one point per time in
+                'at' (e.g. a ship track). Longitudes can be given as
+                -180 to 180 or 0 to 360.
+
+        -   method (str)
+                'nearest' grid point or 'bilinear' interpolation between
+                the four surrounding grid points.
+
+        -   cache (SubsetCache)
+                read from a small local copy of the area around the
+                points instead of the full file (see SubsetCache).
+
+    All of the requested points are looked up on the 1-D latitude and
+    longitude axes at once and read from the file together, so a track of
+    thousands of points costs about the same as a single point.
+    """
+
+    if cache is not None:
+        f = cache.subset(f, v, LAT, LON)
 
     with Dataset(f, 'r') as D:
-        t = num2date(D.variables['time'][:], D.variables['time'].units)
-        if at is not None:
-            times = np.in1d(t, at_times)
-            d = D.variables[v][times]
+        t = decode_times(D.variables['time'][:], D.variables['time'].units)
+
+        if at is None:
+            at_times = t
+        else:
+            at_times = np.array(at, ndmin=1).astype('datetime64[ns]')
+
+        try:
+            LAT, LON = np.broadcast_arrays(np.asarray(LAT, dtype=float).ravel(),
+                                           np.asarray(LON, dtype=float).ravel(), at_times)[:2]
+        except ValueError:
+            raise ValueError('LAT and LON must be single values or one per time in at')
+
+        # exact time matches only
+        order = np.argsort(t)
+        ti = np.searchsorted(t[order], at_times).clip(0, len(t) - 1)
+        ti = np.where(t[order][ti] == at_times, order[ti], -1)
+
+        yi, yw = _axis_index(D.variables['latitude'][:], LAT, method)
+        xi, xw = _axis_index(D.variables['longitude'][:], LON, method, cyclic=True)
+
+        return _read_points(D.variables[v], ti, yi, yw, xi, xw)
+
+class SubsetCache(object):
+    """Local copies of small lat/lon windows of ECMWF files
+
+    Analyses of a fixed site keep pulling the same few grid points out of
+    the same global files. The first request for a (file, variable, area)
+    writes a compact netCDF file holding the full time series over just
+    that window, and later requests are served from it. A subset is
+    rewritten whenever the size or mtime of the source file changes.
+    Subsets are named after the full path of the source, so files with
+    the same name in different folders don't share them.
 
-        hits = np.array([i in t for i in at_times])
+    Arguments
+    ---------------------
+
+        Required:
+
+        -   folder (str): where to keep the subsets, made if needed
+
+        Optional:
+
+        -   pad (int)
+                number of extra grid cells kept around the requested
+                points, so that nearby points (or bilinear interpolation)
+                hit the same subset.
+
+    Example:
+
+        cache = SubsetCache('~/data/ecmwf_subsets')
+        for f in files:
+            t2m = pick_ecmwf_point(f, 't2m', at=times, LAT=39.09, LON=-28.03, cache=cache)
+    """
+
+    def __init__(self, folder, pad=1):
+
+        self.folder = os.path.expanduser(folder)
+        self.pad = pad
+
+        if not os.path.isdir(self.folder):
+            os.makedirs(self.folder)
+
+    def _window(self, D, LAT, LON):
+        """Grid index bounds (y0, y1, x0, x1) around the points
+
+        x1 is less than x0 when the window wraps around the date line
+        of the file's longitude axis.
+        """
 
         lat = D.variables['latitude'][:]
         lon = D.variables['longitude'][:]
+        ny, nx = len(lat), len(lon)
+
+        yi = _axis_index(lat, np.asarray(LAT, dtype=float).ravel(), 'bilinear')[0]
+        xi = _axis_index(lon, np.asarray(LON, dtype=float).ravel(), 'bilinear', cyclic=True)[0]
+        yi, xi = yi[yi >= 0], xi[xi >= 0]
+
+        if not len(yi) or not len(xi):
+            raise ValueError('None of the points are on the grid of {}'.format(D.filepath()))
+
+        y0 = max(yi.min() - self.pad, 0)
+        y1 = min(yi.max() + self.pad, ny - 1)
+
+        u = np.unique(xi)
+        step = abs(lon[-1] - lon[0]) / max(nx - 1, 1)
+        if nx > 1 and abs(lon[-1] - lon[0]) + 1.5 * step >= 360.:
+            # shortest arc around the globe that covers the points,
+            # i.e. everything but the largest gap between them
+            gaps = np.diff(np.append(u, u[0] + nx))
+            k = np.argmax(gaps)
+            x0, x1 = u[(k + 1) % len(u)], u[k]
+            if (x1 - x0) % nx + 1 + 2 * self.pad >= nx:
+                x0, x1 = 0, nx - 1
+            else:
+                x0, x1 = (x0 - self.pad) % nx, (x1 + self.pad) % nx
+        else:
+            x0 = max(u.min() - self.pad, 0)
+            x1 = min(u.max() + self.pad, nx - 1)
+
+        return y0, y1, x0, x1
+
+    def _write(self, f, v, window, path):
+
+        y0, y1, x0, x1 = window
+        st = os.stat(f)
+        tmp = path + '.tmp'
+
+        with Dataset(f, 'r') as S, Dataset(tmp, 'w') as D:
+
+            nx = len(S.variables['longitude'])
+            if x1 >= x0:
+                xs = [slice(x0, x1 + 1)]
+            else:
+                xs = [slice(x0, nx), slice(0, x1 + 1)]
+
+            lon = np.concatenate([S.variables['longitude'][x] for x in xs])
+            # keep longitude increasing across the date line
+            lon = lon[0] + np.mod(lon - lon[0], 360.)
+
+            src = S.variables[v]
+            data = np.concatenate([src[:, y0:y1 + 1, x] for x in xs], axis=-1)
+
+            D.source = os.path.abspath(f)
+            D.source_mtime = st.st_mtime
+            D.source_size = st.st_size
+
+            D.createDimension('time', None)
+            D.createDimension('latitude', y1 - y0 + 1)
+            D.createDimension('longitude', len(lon))
+
+            t = S.variables['time']
+            time = D.createVariable('time', t.dtype, ('time',))
+            time.setncatts(dict((k, t.getncattr(k)) for k in t.ncattrs()))
+            time[:] = t[:]
+
+            lat = D.createVariable('latitude', 'f8', ('latitude',))
+            lat.units = 'degrees_north'
+            lat[:] = S.variables['latitude'][y0:y1 + 1]
+
+            lo = D.createVariable('longitude', 'f8', ('longitude',))
+            lo.units = 'degrees_east'
+            lo[:] = lon
+
+            # store unpacked, the packing attributes don't apply any more
+            x = D.createVariable(v, 'f4', src.dimensions, zlib=True, fill_value=np.nan)
+            x.setncatts(dict((k, src.getncattr(k)) for k in src.ncattrs()
+                             if k not in ('scale_factor', 'add_offset', '_FillValue', 'missing_value')))
+            x[:] = np.ma.filled(np.ma.asarray(data, dtype=np.float32), np.nan)
+
+        os.rename(tmp, path)
+
+    def _is_current(self, f, path):
+
+        if not os.path.isfile(path):
+            return False
+
+        st = os.stat(f)
+        with Dataset(path, 'r') as D:
+            return (D.source == os.path.abspath(f) and
+                    D.source_mtime == st.st_mtime and D.source_size == st.st_size)
+
+    def subset(self, f, v, LAT, LON):
+        """Return the path of the subset of f covering the points
+
+        The subset is written, or rewritten if the source file has
+        changed, as needed. It has the same layout as the source (time,
+        latitude, longitude, and the variable) so it can be used anywhere
+        the source file can.
+        """
+
+        with Dataset(f, 'r') as D:
+            window = self._window(D, LAT, LON)
+
+        stem = os.path.splitext(os.path.basename(f))[0]
+        key = hashlib.md5(os.path.abspath(f).encode('utf-8')).hexdigest()[:8]
+        path = os.path.join(self.folder, '{}.{}.{}.{}-{}.{}-{}.nc'.format(stem, key, v, *window))
+
+        if not self._is_current(f, path):
+            self._write(f, v, window, path)
+
+        return path
+
+
+def _file_times(f):
+
+    with Dataset(f, 'r') as D:
+        t = D.variables['time']
+        return decode_times(t[:], t.units, getattr(t, 'calendar', 'standard'))
+
+
+def _route_times(file_times, at_times, time_method):
+    """Match track times to (file, time index, weight) rows
+
+    Returns (point, file, time index, weight) arrays with one row per
+    field time that a track point draws on: one for 'exact' and 'nearest',
+    up to two for 'linear'. The neighbouring field times may be in
+    different files. Points outside of the files' overall time range, or
+    without an exact match for 'exact', get no rows at all.
+    """
+
+    sizes = [len(t) for t in file_times]
+    all_t = np.concatenate(file_times).astype('datetime64[ns]').view(np.int64)
+    fid = np.repeat(np.arange(len(file_times)), sizes)
+    tid = np.concatenate([np.arange(n) for n in sizes])
+
+    order = np.argsort(all_t, kind='mergesort')
+    all_t, fid, tid = all_t[order], fid[order], tid[order]
+
+    at = at_times.view(np.int64)
+    point = np.arange(len(at))
+    n = len(all_t)
+
+    inside = ~np.isnat(at_times)
+    if n:
+        inside &= (at >= all_t[0]) & (at <= all_t[-1])
+    else:
+        inside[:] = False
+
+    point = point[inside]
+    at = at[inside]
+
+    right = np.searchsorted(all_t, at).clip(0, n - 1)
+    exact = all_t[right] == at
+    left = np.where(exact, right, (right - 1).clip(0, n - 1))
+
+    if time_method == 'exact':
+        point, g, w = point[exact], right[exact], np.ones(exact.sum())
+    elif time_method == 'nearest':
+        g = np.where(at - all_t[left] <= all_t[right] - at, left, right)
+        w = np.ones(len(point))
+    elif time_method == 'linear':
+        span = (all_t[right] - all_t[left]).astype(float)
+        w_right = np.where(exact, 0., (at - all_t[left]) / np.where(exact, 1., span))
+        point = np.concatenate([point, point])
+        g = np.concatenate([left, right])
+        w = np.concatenate([1. - w_right, w_right])
+        keep = w > 0
+        point, g, w = point[keep], g[keep], w[keep]
+    else:
+        raise ValueError("time_method must be 'exact', 'nearest', or 'linear'")
+
+    return point, fid[g], tid[g], w
+
+
+def _sample_file(args):
+    """Sample one file at its share of the track points (a pmap job)"""
+
+    f, variables, ti, LAT, LON, method = args
+
+    with Dataset(f, 'r') as D:
+        yi, yw = _axis_index(D.variables['latitude'][:], LAT, method)
+        xi, xw = _axis_index(D.variables['longitude'][:], LON, method, cyclic=True)
+
+        values = dict()
+        for v in variables:
+            if v not in D.variables:
+                warnings.warn('{} is not in {}'.format(v, f))
+                values[v] = np.full(len(ti), np.nan)
+            else:
+                values[v] = _read_points(D.variables[v], ti, yi, yw, xi, xw)
+
+    return values
+
+
+def sample_track(files, variables, at, LAT, LON, method='nearest', time_method='nearest',
+                 workers=None, executor=None):
+    """Sample ECMWF variables along a track that spans several files
+
+    Each track point is sent to the file(s) holding the field times around
+    it, and each file is only read at its own points, in the lat/lon box
+    around them (see pick_ecmwf_point).
+
+    Arguments
+    ---------------------
+
+        Required:
+
+        -   files (list): ECMWF netCDF files, e.g. one per month
+
+        -   variables (str or list): variable names, e.g. ['t2m', 'sp']
+
+        -   at (array): track times
+
+        -   LAT, LON (float or array)
+                track positions, one per time in 'at', or a single
+                position for a site.
+
+        Optional:
+
+        -   method (str)
+                'nearest' grid point or 'bilinear' in space
+
+        -   time_method (str)
+                'nearest' field time, 'linear' interpolation between the
+                field times on either side (which may be in different
+                files), or 'exact' matches only.
+
+        -   workers, executor
+                see toolbox.tools.pmap. The files are read in parallel,
+                in a process pool by default, since netCDF4 isn't thread
+                safe.
+
+    Returns a DataFrame with one column per variable and one row per
+    track point, in track order. Points outside of the time range of the
+    files are NaN.
+    """
+
+    if isinstance(variables, str):
+        variables = [variables]
+
+    at_times = np.array(at, ndmin=1).astype('datetime64[ns]')
+
+    try:
+        LAT, LON = np.broadcast_arrays(np.asarray(LAT, dtype=float).ravel(),
+                                       np.asarray(LON, dtype=float).ravel(), at_times)[:2]
+    except ValueError:
+        raise ValueError('LAT and LON must be single values or one per time in at')
+
+    file_times = [_file_times(f) for f in files]
+    point, fid, tid, weight = _route_times(file_times, at_times, time_method)
+
+    order = np.argsort(fid, kind='mergesort')
+    point, fid, tid, weight = point[order], fid[order], tid[order], weight[order]
+    used, first = np.unique(fid, return_index=True)
+    groups = np.split(np.arange(len(fid)), first[1:])
+
+    jobs = ((files[k], variables, tid[rows], LAT[point[rows]], LON[point[rows]], method)
+            for k, rows in zip(used, groups))
+
+    out = dict((v, np.zeros(len(at_times))) for v in variables)
+    for rows, values in zip(groups, pmap(_sample_file, jobs, workers=workers, executor=executor)):
+        for v in variables:
+            np.add.at(out[v], point[rows], weight[rows] * values[v])
+
+    missing = np.ones(len(at_times), dtype=bool)
+    missing[point] = False
+    for v in variables:
+        out[v][missing] = np.nan
 
-        lons, lats = np.meshgrid(lon, lat)
-
-        #return lons, lats, shiftlon(LON), LAT
-
-        ix=0
-
-        if isinstance(LAT, float):
-            lat_loc = lats == int(LAT)
-            lon_loc = lons == int(shiftlon(LON))
-            loc = lat_loc & lon_loc
-            for i, (a, h) in enumerate(zip(at_times, hits)):
-                if h:
-                    try:
-                        vout[i] = d[ix, loc.nonzero()[0], loc.nonzero()[1]].squeeze()
-                    except ValueError:
-                        print(ix, loc.nonzero())
-                        print(d[ix, loc.nonzero()[0], loc.nonzero()[1]].squeeze())
-                        return
-                    ix += 1
-
-        elif len(at_times) == len(LAT):
-            for i, (a, la, lo, h) in enumerate(zip(at_times, LAT, LON, hits)):
-                if h:
-                    lat_loc = lats == int(la)
-                    lon_loc = lons == int(shiftlon(lo))
-                    loc = lat_loc & lon_loc
-
-                    vout[i] = d[ix, loc.nonzero()[0], loc.nonzero()[1]].squeeze()
-
-                    ix += 1
-    return vout
+    return pd.DataFrame(out, index=pd.DatetimeIndex(at_times), columns=variables)
 
 def get_ecmwf_grid(file, variable, dtime):
     pass
@@ -4,4 +4,8 @@ from netCDF import NetCDFFile
 from netCDF import NetCDFFolder
 import HDF
 from ECMWF import pick_ecmwf_point
-from uhsas import UHSAS
\ No newline at end of file
+from ECMWF import sample_track
+from ECMWF import SubsetCache
+from uhsas import UHSAS
+from uhsas import UHSASFolder
+from times import decode_times
@@ -0,0 +1,223 @@
+__author__ = 'Jayson Stemmler'
+__created__ = "10/18/26 2:05 PM"
+
+"""
+    Lazy view of a NetCDFFolder that only reads what is asked for.
+
+    Opening a LazyFrame doesn't read any data, it only needs the header
+    of each file (time coverage and variable names), which come from the
+    folder's header index. Column selection is free, and time slices and
+    resampling only read the files, and the part of each file, that fall
+    inside the requested time window.
+"""
+
+import numpy as np
+import pandas as pd
+
+_HOW = ('mean', 'sum', 'count', 'min', 'max')
+
+
+class _LocIndexer(object):
+
+    def __init__(self, lazy):
+        self._lazy = lazy
+
+    def __getitem__(self, key):
+
+        columns = None
+        if isinstance(key, tuple):
+            key, columns = key
+
+        if not isinstance(key, slice) or key.step is not None:
+            raise TypeError('LazyFrame.loc only supports time slices, e.g. lazy.loc[start:end]')
+
+        lazy = self._lazy if columns is None else self._lazy[columns]
+
+        return lazy.between(key.start, key.stop).to_frame()
+
+
+class LazyFrame(object):
+    """Lazy, multi-file DataFrame for a folder of netCDF files
+
+    Made by NetCDFFolder.open_lazy(), not meant to be created directly.
+
+    Arguments
+    ---------------------
+
+        -   folder (NetCDFFolder): the folder the files come from
+
+        -   columns (list): the variables to read
+
+        -   extents (DataFrame): one row per file with 'start' and 'end'
+                columns holding the time coverage of each file, indexed
+                on the full file path and sorted by start time.
+
+        -   workers, executor: passed to NetCDFFolder when reading
+                several files (see toolbox.tools.pmap)
+    """
+
+    def __init__(self, folder, columns, extents, workers=None, executor=None):
+
+        self.folder = folder
+        self.columns = list(columns)
+        self.extents = extents
+        self.workers = workers
+        self.executor = executor
+
+        self.start = None
+        self.end = None
+
+    def __repr__(self):
+
+        if len(self.extents):
+            span = '{} to {}'.format(self.extents['start'].min(), self.extents['end'].max())
+        else:
+            span = 'no data'
+
+        return '<LazyFrame: {} files, {}, columns: {}>'.format(len(self.extents), span,
+                                                               ', '.join(self.columns))
+
+    def _copy(self, **kwargs):
+
+        new = LazyFrame(self.folder, kwargs.pop('columns', self.columns), self.extents,
+                        workers=self.workers, executor=self.executor)
+        new.start = kwargs.pop('start', self.start)
+        new.end = kwargs.pop('end', self.end)
+
+        return new
+
+    def __getitem__(self, columns):
+        """Select columns without reading anything"""
+
+        if isinstance(columns, str):
+            columns = [columns]
+
+        missing = [c for c in columns if c not in self.columns]
+        if len(missing):
+            raise KeyError('Columns not found: {}'.format(', '.join(missing)))
+
+        return self._copy(columns=columns)
+
+    @property
+    def loc(self):
+        """Time slicing, e.g. lazy.loc['2014-03-15':'2014-03-20', ['CCN']]
+
+        Returns a regular DataFrame, read from only the overlapping files.
+        """
+
+        return _LocIndexer(self)
+
+    def between(self, start=None, end=None):
+        """Return a new LazyFrame restricted to a time window (inclusive)"""
+
+        if start is not None:
+            start = pd.Timestamp(start)
+            if self.start is not None:
+                start = max(start, self.start)
+        else:
+            start = self.start
+
+        if end is not None:
+            end = pd.Timestamp(end)
+            if self.end is not None:
+                end = min(end, self.end)
+        else:
+            end = self.end
+
+        return self._copy(start=start, end=end)
+
+    def files(self):
+        """Return the files that overlap the current time window"""
+
+        keep = np.ones(len(self.extents), dtype=bool)
+        if self.start is not None:
+            keep &= (self.extents['end'] >= self.start).values
+        if self.end is not None:
+            keep &= (self.extents['start'] <= self.end).values
+
+        return list(self.extents.index[keep])
+
+    def iter_frames(self):
+        """Yield one DataFrame per overlapping file, in time order"""
+
+        files = self.files()
+
+        for f, frame in self.folder._read_files(files, self.columns,
+                                                workers=self.workers,
+                                                executor=self.executor,
+                                                start=self.start, end=self.end):
+            if frame is not None:
+                yield frame
+
+    def to_frame(self):
+        """Read everything in the current selection into a DataFrame"""
+
+        frames = list(self.iter_frames())
+
+        if not len(frames):
+            return pd.DataFrame(columns=self.columns)
+
+        return pd.concat(frames).sort_index()
+
+    def resample(self, rule, how='mean'):
+        """Resample the selection, one file at a time
+
+        Each file is reduced to per-bin partial aggregates as it is read,
+        and the partial aggregates of bins that span files are combined at
+        the end, so only one file is in memory at a time. The bins of every
+        file start from midnight of the first day of the selection, the
+        same as resampling the whole selection with pandas.
+
+        -   rule (str): pandas offset alias, e.g. '1H' or '6H'
+        -   how (str): one of 'mean', 'sum', 'count', 'min', or 'max'
+        """
+
+        if how not in _HOW:
+            raise ValueError('how must be one of {}'.format(', '.join(_HOW)))
+
+        # fixed-length bins are counted from one origin for all files;
+        # calendar rules ('MS', 'W', ...) line up across files by themselves
+        try:
+            step = pd.Timedelta(rule)
+        except ValueError:
+            step = None
+
+        origin = None
+        parts = []
+        for frame in self.iter_frames():
+            if not len(frame):
+                continue
+
+            # files come in time order, so the first one sets the origin
+            if origin is None:
+                origin = frame.index.min().floor('D')
+
+            if step is not None:
+                grouped = frame.groupby(origin + (frame.index - origin) // step * step)
+            else:
+                grouped = frame.groupby(pd.Grouper(freq=rule))
+
+            if how == 'mean':
+                parts.append(pd.concat({'sum': grouped.sum(), 'count': grouped.count()}, axis=1))
+            else:
+                parts.append(getattr(grouped, how)())
+
+        if not len(parts):
+            return pd.DataFrame(columns=self.columns)
+
+        combined = pd.concat(parts).groupby(level=0)
+
+        if how == 'mean':
+            totals = combined.sum()
+            result = totals['sum'] / totals['count']
+        elif how in ('sum', 'count'):
+            result = combined.sum()
+        else:
+            result = getattr(combined, how)()
+
+        # fill in empty bins between files, like pandas resample does
+        # (NaN, except for sums and counts, which are 0)
+        full = pd.date_range(result.index[0], result.index[-1], freq=rule)
+        fill = 0 if how in ('sum', 'count') else np.nan
+
+        return result.reindex(full, fill_value=fill)[self.columns]
@@ -0,0 +1,199 @@
+__author__ = 'Jayson Stemmler'
+__created__ = "10/18/26 9:12 AM"
+
+"""
+    A cache of netCDF header information (variables, dimensions, units,
+    time coverage) for a folder of files, so that things like variable
+    name lookups and folder summaries don't have to reopen every file.
+
+    Entries are keyed on the file basename and are thrown out whenever
+    the size or modification time of the file on disk changes. Files
+    sharing the same set of variables share a single schema entry, which
+    keeps the index small for long datastreams.
+"""
+
+import os
+import json
+import hashlib
+
+import numpy as np
+from netCDF4 import Dataset
+
+from ..tools import pmap
+from .times import decode_times
+
+
+def read_header(f):
+    """Read the header information for a single netCDF file
+
+    Returns a dictionary with the file size and mtime, a dictionary of
+    variables (long_name, units, dimensions), and the first and last
+    times in ISO format if the file has a 'time' variable.
+    """
+
+    st = os.stat(f)
+    header = dict(size=st.st_size, mtime=st.st_mtime, time=None, ntime=0)
+
+    with Dataset(f, 'r') as D:
+        variables = dict()
+        for k, v in D.variables.items():
+            variables[k] = dict(long_name=str(getattr(v, 'long_name', 'None')),
+                                units=str(getattr(v, 'units', 'None')),
+                                dimensions=list(v.dimensions))
+
+        header['variables'] = variables
+
+        if 'time' in D.variables and hasattr(D.variables['time'], 'units'):
+            t = D.variables['time']
+            n = len(t)
+            if n:
+                first, last = decode_times(np.array([t[0], t[n-1]]), t.units,
+                                           getattr(t, 'calendar', 'standard'))
+                header['time'] = [str(np.datetime_as_string(first, unit='s')),
+                                  str(np.datetime_as_string(last, unit='s'))]
+                header['ntime'] = n
+
+    return header
+
+
+def _read_header(f):
+    """read_header for MetadataIndex.update
+
+    Lives at module level so that it can be sent to a process pool.
+    Returns a (filename, header, error) tuple instead of raising so that
+    one unreadable file does not abort the rest of the update.
+    """
+    try:
+        return f, read_header(f), None
+    except Exception as e:
+        return f, None, e
+
+
+class MetadataIndex(object):
+    """Header cache for a set of netCDF files
+
+    Arguments
+    ---------------------
+
+        Optional:
+
+        -   path (str)
+                where to keep the index on disk (JSON). If None the index
+                only lives in memory for the life of the object.
+    """
+
+    def __init__(self, path=None):
+
+        self.path = path
+        self.files = dict()
+        self.schemas = dict()
+        self._dirty = False
+
+        if path is not None and os.path.isfile(path):
+            try:
+                with open(path, 'r') as fh:
+                    cached = json.load(fh)
+                self.files = cached['files']
+                self.schemas = cached['schemas']
+            except (ValueError, KeyError):
+                # corrupt or old index, just rebuild it
+                pass
+
+    def _is_current(self, f):
+
+        entry = self.files.get(os.path.basename(f))
+        if entry is None:
+            return False
+
+        try:
+            st = os.stat(f)
+        except OSError:
+            return False
+
+        return entry['size'] == st.st_size and entry['mtime'] == st.st_mtime
+
+    def _add(self, f, header):
+
+        variables = header.pop('variables')
+
+        # ARM time units change with every file ("seconds since <file start>"),
+        # keep them out of the schema so that the rest of it can be shared
+        if 'time' in variables:
+            variables['time'] = dict(variables['time'])
+            header['time_units'] = variables['time'].pop('units')
+
+        schema = hashlib.md5(json.dumps(variables, sort_keys=True)
+                             .encode('utf-8')).hexdigest()
+        self.schemas[schema] = variables
+
+        header['schema'] = schema
+        self.files[os.path.basename(f)] = header
+        self._dirty = True
+
+    def update(self, files, workers=None, executor=None):
+        """Make sure every file in 'files' has a current entry
+
+        Stale or missing entries are (re)read, optionally in a worker pool
+        (see toolbox.tools.pmap), and the index is saved if anything changed.
+        Files whose header can't be read are left out of the index and
+        returned as a dictionary of {filename: error}.
+        """
+
+        stale = [f for f in files if not self._is_current(f)]
+        failed = dict()
+
+        for f, header, err in pmap(_read_header, stale, workers=workers, executor=executor):
+            if err is not None:
+                # drop any entry left over from an older version of the file
+                if self.files.pop(os.path.basename(f), None) is not None:
+                    self._dirty = True
+                failed[f] = err
+            else:
+                self._add(f, header)
+
+        self.save()
+
+        return failed
+
+    def header(self, f):
+        """Return the header of a single file, reading it if needed
+
+        The result is the same as read_header(f), except that the variable
+        descriptions are shared with other files that have the same schema,
+        so don't modify them. Raises the read error if the file has no
+        current entry and can't be read.
+        """
+
+        if not self._is_current(f):
+            self._add(f, read_header(f))
+
+        entry = dict(self.files[os.path.basename(f)])
+        entry['variables'] = self.schemas[entry['schema']]
+
+        if 'time_units' in entry:
+            entry['variables'] = dict(entry['variables'])
+            entry['variables']['time'] = dict(entry['variables']['time'],
+                                              units=entry.pop('time_units'))
+
+        return entry
+
+    def save(self):
+        """Write the index to disk, if it has a path and has changed"""
+
+        if self.path is None or not self._dirty:
+            return
+
+        # only keep schemas that are still in use
+        used = set(e['schema'] for e in self.files.values())
+        self.schemas = dict((k, v) for k, v in self.schemas.items() if k in used)
+
+        tmp = self.path + '.tmp'
+        try:
+            with open(tmp, 'w') as fh:
+                json.dump(dict(files=self.files, schemas=self.schemas), fh)
+            os.rename(tmp, self.path)
+        except (IOError, OSError):
+            # read-only location, the index still works from memory
+            return
+
+        self._dirty = False
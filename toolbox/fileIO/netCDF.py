@@ -1,15 +1,23 @@
 __author__ = "Jayson Stemmler"
 
 import os
+import re
 import glob
+import fnmatch
 import warnings
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
 import numpy as np
 import pandas as pd
 import tables
 
-from netCDF4 import Dataset, num2date
+from netCDF4 import Dataset, date2num
 
-# from ..tools import ProgressBar
+from ..tools import pmap
+from .ncindex import MetadataIndex
+from .lazy import LazyFrame
+from .times import decode_times
 
 
 class VariableError(Exception):
@@ -22,6 +30,66 @@ class VariableWarning(Warning):
     pass
 
 
+class FileReadWarning(Warning):
+    """Warning for files that could not be read as part of a folder"""
+    pass
+
+
+def _read_file(args):
+    """Read a single file for NetCDFFolder.process
+
+    Lives at module level so that it can be sent to a process pool.
+    Returns a (filename, data, error) tuple instead of raising so that
+    one bad file does not abort the rest of the folder.
+    """
+    f, varlist, kwargs, header = args
+    try:
+        return f, NetCDFFile(f, header=header).get_vars(varlist=varlist, **dict(kwargs)), None
+    except Exception as e:
+        return f, None, e
+
+
+def _combine_frames(frames):
+    """Concatenate per-file outputs into one time-sorted DataFrame
+
+    Returns None if there is nothing to combine, and the list unchanged if
+    any of the outputs is not a pandas object.
+    """
+
+    if not len(frames):
+        return None
+
+    # rudimentary way to check if the content of the frames is a pandas object
+    # TODO: figure out a better way to check and evaluate this
+    is_frame = np.array(['pandas' in str(type(i)) for i in frames])
+
+    if is_frame.all():
+        return pd.concat(frames).sort_index()
+    else:
+        return frames
+
+
+# ARM filenames look like <datastream>.<level>.YYYYMMDD.hhmmss.<ext>
+_ARM_TIME = re.compile(r'^(.*)\.(\d{8})\.(\d{6})\.[^.]+$')
+
+
+def _filename_time(f):
+    """Return (datastream, start time) from an ARM-style filename
+
+    Returns (None, None) if the filename doesn't contain a date.
+    """
+
+    match = _ARM_TIME.match(os.path.basename(f))
+    if match is None:
+        return None, None
+
+    try:
+        return match.group(1), pd.to_datetime(match.group(2) + match.group(3),
+                                              format='%Y%m%d%H%M%S')
+    except ValueError:
+        return None, None
+
+
 class NetCDFFolder(object):
     """Sets up the NetCDFFolder class object
 
@@ -54,6 +122,23 @@ class NetCDFFolder(object):
                 list, or have a narrower list, you may modify to
                 your liking. This argument can also be a string.
 
+        -   index (bool, str)
+                keep a cache of the file headers (variables, units,
+                time coverage) on disk so they don't have to be read
+                from every file each time. True puts the cache next
+                to the folder as '.<folder>.ncindex.json', a string
+                is used as the cache path. Default is None (no cache).
+
+        -   start, end (datetime, str)
+                only keep files with data inside this time window.
+                The start time of each file is taken from ARM-style
+                filenames (e.g. enaaosuhsasC1.a1.20140315.000006.cdf)
+                and a file is assumed to run until the next file in
+                its datastream. Files without a date in the name, and
+                the last file of each datastream, are checked against
+                the time coverage in their header (see 'index'); files
+                whose header can't be read are kept.
+
     Raises
     --------------------------
 
@@ -61,7 +146,8 @@ class NetCDFFolder(object):
 
         IOError: If the folder cannot be found on disk.
     """
-    def __init__(self, folder, pat=None, ext=('nc', 'cdf')):
+    def __init__(self, folder, pat=None, ext=('nc', 'cdf'), index=None,
+                 start=None, end=None):
 
         if not isinstance(folder, str):
             raise TypeError('Folder is not a string')
@@ -86,7 +172,107 @@ class NetCDFFolder(object):
         else:
             filelist = glob.glob(os.path.join(self.abspath, '*{}*'.format(pat)))
 
-        self.filelist = np.array(filelist, dtype=str)
+        # ARM-style filenames sort chronologically within a datastream
+        self.filelist = np.array(sorted(filelist), dtype=str)
+        self.failed = dict()
+
+        if index is True:
+            parent, name = os.path.split(self.abspath)
+            index = os.path.join(parent, '.{}.ncindex.json'.format(name))
+
+        if index is None or index is False:
+            self.index = None
+        elif isinstance(index, str):
+            self.index = MetadataIndex(index)
+        else:
+            raise TypeError('index must be True, None, or a path string')
+
+        self.start = None if start is None else pd.Timestamp(start)
+        self.end = None if end is None else pd.Timestamp(end)
+
+        if self.start is not None or self.end is not None:
+            self.filelist = self._prune_by_time(self.filelist)
+
+    def _prune_by_time(self, filelist):
+        """Drop files that don't overlap with self.start/self.end"""
+
+        def overlaps(first, last):
+            return ((self.end is None or first <= self.end) and
+                    (self.start is None or last is None or last >= self.start))
+
+        # start time of the next file in the same datastream, if there is one
+        stamps = [_filename_time(f) for f in filelist]
+        next_start = [None] * len(filelist)
+        last_seen = dict()
+        for i in range(len(filelist) - 1, -1, -1):
+            stream, first = stamps[i]
+            if stream is not None:
+                next_start[i] = last_seen.get(stream)
+                last_seen[stream] = first
+
+        keep = []
+        unknown = []
+        for f, (stream, first), nxt in zip(filelist, stamps, next_start):
+            if first is None or nxt is None:
+                if first is None or self.end is None or first <= self.end:
+                    unknown.append(f)
+            elif overlaps(first, nxt - pd.Timedelta(1)):
+                keep.append(f)
+
+        # fall back on the time coverage in the headers
+        if len(unknown):
+            if self.index is None:
+                index = MetadataIndex()
+            else:
+                index = self.index
+
+            # a file whose header can't be read is kept, so that reading it
+            # later reports it through self.failed instead of the constructor
+            # raising here
+            failed = index.update(unknown)
+            for f in unknown:
+                if f in failed:
+                    keep.append(f)
+                    continue
+
+                coverage = index.header(f)['time']
+                if coverage is None or overlaps(pd.Timestamp(coverage[0]),
+                                                pd.Timestamp(coverage[1])):
+                    keep.append(f)
+
+        return np.array(sorted(keep), dtype=str)
+
+    def _update_index(self, files, workers=None, executor=None):
+        """Bring the header index up to date for 'files'
+
+        Files whose header can't be read are recorded in self.failed with
+        a FileReadWarning. Returns the files that do have a header.
+        """
+
+        failed = self.index.update(files, workers=workers, executor=executor)
+
+        for f in sorted(failed):
+            self.failed[f] = failed[f]
+            warnings.warn('Could not read {}: {}'.format(os.path.basename(f), failed[f]),
+                          FileReadWarning)
+
+        return [f for f in files if f not in failed]
+
+    def headers(self, workers=None, executor=None):
+        """Return the header information for every file in the folder
+
+        Output is a dictionary keyed on file basename, see
+        toolbox.fileIO.ncindex.read_header for the contents. Without an
+        on-disk index the headers are only cached in memory. Files whose
+        header can't be read are left out and recorded in self.failed.
+        """
+
+        if self.index is None:
+            self.index = MetadataIndex()
+
+        files = self._update_index(self.filelist, workers=workers, executor=executor)
+
+        return dict((os.path.basename(f), self.index.header(f)) for f in files)
 
     def summary(self, detailed=True, **kwargs):
         """Print a summary of the folder contents"""
@@ -96,28 +282,132 @@ class NetCDFFolder(object):
 
         if detailed:
             streams = dict()
+            coverage = dict()
             sep = kwargs.pop('sep', '.')
 
+            indexed = set()
+            if self.index is not None:
+                indexed = set(self._update_index(self.filelist))
+
             for f in self.filelist:
                 bn = os.path.basename(f).split(sep)[0]
                 if bn in streams.keys():
                     streams[bn] += 1
                 else:
                     streams[bn] = 1
+
+                if f in indexed and self.index.header(f)['time'] is not None:
+                    first, last = self.index.header(f)['time']
+                    if bn in coverage:
+                        coverage[bn] = (min(first, coverage[bn][0]), max(last, coverage[bn][1]))
+                    else:
+                        coverage[bn] = (first, last)
+
             streamlen = []
-            for k, v in streams.iteritems():
+            for k, v in sorted(streams.items()):
                 dstreamstring = " > Found {} items for datastream {}".format(v, k)
+                if k in coverage:
+                    dstreamstring += " ({} to {})".format(*coverage[k])
                 print(dstreamstring)
                 streamlen.append(len(dstreamstring))
 
             print('='*np.max(streamlen)+'\n')
 
+    def _select_files(self, include=None):
+        """Return the files in self.filelist that contain 'include'"""
+
+        if (include is not None) and (not isinstance(include, str)):
+            raise TypeError('include is not proper type')
+
+        return [f for f in self.filelist if (include is None) or (include in f)]
+
+    def _read_files(self, files, varlist, workers=None, executor=None, window=None, **kwargs):
+        """Yield (filename, data) for each file that could be read, in order
+
+        With a worker pool at most 'window' files are read ahead of the
+        consumer (see toolbox.tools.pmap).
+        """
+
+        # only read the part of each file inside the folder's time window
+        if self.start is not None:
+            kwargs.setdefault('start', self.start)
+        if self.end is not None:
+            kwargs.setdefault('end', self.end)
+
+        self.failed = dict()
+
+        if self.index is not None:
+            # files without a readable header are reported here, not read
+            files = self._update_index(files, workers=workers, executor=executor)
+            args = [(f, varlist, kwargs, self.index.header(f)) for f in files]
+        else:
+            args = [(f, varlist, kwargs, None) for f in files]
+
+        for f, frame, err in pmap(_read_file, args, workers=workers, executor=executor,
+                                  window=window):
+            if err is not None:
+                self.failed[f] = err
+                warnings.warn('Could not read {}: {}'.format(os.path.basename(f), err),
+                              FileReadWarning)
+            else:
+                yield f, frame
+
+    def iter_frames(self, varlist=None, chunk=1, **kwargs):
+        """Iterate over the folder in time-ordered chunks of files
+
+        Instead of holding the entire folder in memory like process(), this
+        generator yields one time-sorted DataFrame per 'chunk' files, so
+        aggregation or saving can be done a piece at a time. Files are read
+        in filename order, which for ARM datastreams is time order.
+
+        Takes the same keywords as process() ('include', 'workers',
+        'executor') plus anything accepted by NetCDFFile.get_vars. A worker
+        pool reads at most one chunk per worker (chunk x workers files)
+        ahead of the consumer, so memory doesn't grow with the folder.
+
+        If the variables can't be put into a DataFrame (see
+        NetCDFFile.get_vars) the chunk is yielded as a list of the per-file
+        outputs instead.
+        """
+
+        if not isinstance(chunk, int) or chunk < 1:
+            raise TypeError('chunk must be a positive integer')
+
+        files = self._select_files(kwargs.pop('include', None))
+
+        if kwargs.get('workers') is not None:
+            kwargs.setdefault('window', chunk * kwargs['workers'])
+
+        frames = []
+        for f, frame in self._read_files(files, varlist, **kwargs):
+            if frame is not None:
+                frames.append(frame)
+
+            if len(frames) == chunk:
+                yield _combine_frames(frames)
+                frames = []
+
+        if len(frames):
+            yield _combine_frames(frames)
+
     def process(self, varlist=None, savefile=None, **kwargs):
-        """Process each netCDF file using the NetCDFFile class"""
+        """Process each netCDF file using the NetCDFFile class
+
+        Files can be read in parallel by passing 'workers' (number of pool
+        workers) and/or 'executor' ('process', 'thread', or an existing pool;
+        see toolbox.tools.pmap). The default pool is a process pool, since
+        most netCDF4/HDF5 builds are not safe to call from several threads.
+        Files that fail to read are skipped with a FileReadWarning and
+        collected in self.failed, keyed on filename. The concatenated output
+        is sorted on its time index.
+
+        For long records that don't fit in memory use iter_frames(), and to
+        keep an HDF5 file up to date with a growing folder use update_store().
+        """
 
         # allows setting an optional string here for which files to include in analysis.
         # the routine will check to see if 'include' is in the filename.
-        include = kwargs.pop('include', None)
+        files = self._select_files(kwargs.pop('include', None))
 
         # if you would like to save the output as an hdf5 file, use the
         # keyword "savefile"
@@ -129,27 +419,13 @@ class NetCDFFolder(object):
                 raise IOError('Save path "{}" does not exist'.
                               format(os.path.split(savefile)[0]))
 
-        frames = []
-
-        for f in self.filelist:
-            if (include is not None) and (not isinstance(include, str)):
-                raise TypeError('include is not proper type')
-
-            if (include is None) or (include in f):
-                frames.append(NetCDFFile(f).get_vars(varlist=varlist, **kwargs))
-            else:
-                continue
-
-        # rudimentary way to check if the content of the frames is a pandas object
-        # TODO: figure out a better way to check and evaluate this
-        is_frame = np.array(['pandas' in str(type(i)) or i is None
-                             for i in frames])
+        frames = [frame for f, frame in self._read_files(files, varlist, **kwargs)
+                  if frame is not None]
 
         # currently only returns values if everything plays nice with Pandas
         # TODO: make NetCDFFolder.process output allow more output types
-        if is_frame.all():
-            data = pd.concat(frames)
-        else:
+        data = _combine_frames(frames)
+        if isinstance(data, list):
             data = None
 
         if data is not None and savefile is not None:
@@ -160,6 +436,284 @@ class NetCDFFolder(object):
 
         return data
 
+    def open_lazy(self, varlist=None, exclude=None, workers=None, executor=None):
+        """Return a LazyFrame over the folder instead of reading it
+
+        Only the file headers are read (through the header index, so this
+        is fast on a folder opened with index=True). Column selection, .loc
+        time slices and .resample() on the result only read the files, and
+        the parts of files, that they need. See toolbox.fileIO.lazy.
+
+        Only variables that are a function of time alone can be columns.
+        """
+
+        if varlist is None:
+            raise VariableError('Error: varlist not supplied')
+
+        headers = self.headers(workers=workers, executor=executor)
+
+        columns = []
+        files, starts, ends = [], [], []
+
+        for f in self.filelist:
+            header = headers.get(os.path.basename(f))
+            if header is None or header['time'] is None:
+                continue
+
+            files.append(f)
+            starts.append(pd.Timestamp(header['time'][0]))
+            ends.append(pd.Timestamp(header['time'][1]))
+
+            if not len(columns):
+                variables = header['variables']
+                index = VariableIndex.for_keys(variables.keys(), schema=header['schema'])
+                names = index.resolve([varlist] if isinstance(varlist, str) else varlist, exclude)
+                columns = [n for n in names if variables[n]['dimensions'] == ['time']]
+
+        if not len(columns):
+            raise VariableError('Error: No matching time series variables found')
+
+        extents = pd.DataFrame({'start': starts, 'end': ends}, index=files,
+                               columns=['start', 'end']).sort_values('start')
+
+        lazy = LazyFrame(self, columns, extents, workers=workers, executor=executor)
+
+        return lazy.between(self.start, self.end)
+
+    def update_store(self, savefile, varlist=None, key='data', **kwargs):
+        """Incrementally append the folder to a table-format HDF5 store
+
+        Each file is appended to the table 'key' in savefile as soon as it
+        is read, and its name is recorded in the table '<key>_files'. On
+        the next call only files that aren't recorded yet are read, so a
+        daily job only has to pay for the newest file. Files that fail to
+        read are not recorded and will be retried next time.
+
+        Takes the same keywords as process(). The store can be read back
+        with pandas.read_hdf or toolbox.fileIO.HDF.read_file.
+
+        Returns the list of files that were ingested on this call.
+        """
+
+        savefile = os.path.abspath(savefile)
+        if not os.path.isdir(os.path.split(savefile)[0]):
+            raise IOError('Save path "{}" does not exist'.
+                          format(os.path.split(savefile)[0]))
+
+        files = self._select_files(kwargs.pop('include', None))
+        files_key = '{}_files'.format(key)
+
+        ingested = []
+
+        with pd.HDFStore(savefile, mode='a') as store:
+            if files_key in store:
+                done = set(store[files_key]['filename'])
+            else:
+                done = set()
+
+            new_files = [f for f in files if os.path.basename(f) not in done]
+
+            for f, frame in self._read_files(new_files, varlist, **kwargs):
+                if frame is not None:
+                    if 'pandas' not in str(type(frame)):
+                        raise TypeError('Only DataFrame output can be appended to {}'
+                                        .format(savefile))
+                    store.append(key, frame)
+
+                store.append(files_key,
+                             pd.DataFrame({'filename': [os.path.basename(f)]}),
+                             min_itemsize={'filename': 255}, index=False)
+                ingested.append(f)
+
+        return ingested
+
+class VariableIndex(object):
+    """Lookup of requested variable names against a set of netCDF keys
+
+    Each requested name can be:
+
+        - an exact variable name
+        - a substring of variable names, e.g. 'concentration'
+        - a glob pattern, e.g. 'qc_*'
+        - a compiled regular expression, e.g. re.compile('^wspd_')
+
+    Matches are remembered per pattern, and indexes are shared between
+    all files with the same variables (see for_keys), so resolving the
+    same varlist across a folder of files only does the matching once.
+    """
+
+    _shared = dict()
+
+    @classmethod
+    def for_keys(cls, keys, schema=None):
+        """Return the shared index for a set of keys
+
+        If the schema id from the header index is known it is used as the
+        lookup key instead of the full tuple of variable names.
+        """
+
+        lookup = schema if schema is not None else tuple(sorted(keys))
+
+        index = cls._shared.get(lookup)
+        if index is None:
+            index = cls._shared[lookup] = cls(keys)
+
+        return index
+
+    def __init__(self, keys):
+
+        self.keys = tuple(sorted(keys))
+        self._exact = set(self.keys)
+        self._matches = dict()
+
+    def match(self, pattern):
+        """Return the keys matched by a single name or pattern"""
+
+        found = self._matches.get(pattern)
+        if found is not None:
+            return found
+
+        if hasattr(pattern, 'search'):
+            found = tuple(k for k in self.keys if pattern.search(k))
+        elif not isinstance(pattern, str):
+            raise TypeError("Hey, {} is not a string".format(pattern))
+        elif pattern in self._exact:
+            found = (pattern,)
+        elif any(c in pattern for c in '*?['):
+            found = tuple(fnmatch.filter(self.keys, pattern))
+        else:
+            found = tuple(k for k in self.keys if pattern in k)
+
+        self._matches[pattern] = found
+        return found
+
+    def resolve(self, varlist, exclude=None):
+        """Return the list of keys matched by varlist, in request order
+
+        Keys containing 'exclude' (a string or a list of strings) are
+        dropped from pattern matches. A name that is asked for exactly is
+        always kept.
+        """
+
+        if exclude is None:
+            exclude = ()
+        elif isinstance(exclude, str):
+            exclude = (exclude,)
+
+        names = []
+        seen = set()
+
+        for pattern in varlist:
+            found = self.match(pattern)
+
+            if not len(found):
+                warnings.warn('Warning: {} not found in varlist'.format(pattern), VariableWarning)
+                continue
+
+            exact = isinstance(pattern, str) and pattern in self._exact
+
+            for k in found:
+                if k in seen:
+                    continue
+                if not exact and any(e in k for e in exclude):
+                    continue
+                names.append(k)
+                seen.add(k)
+
+        return names
+
+
+class DatasetCache(object):
+    """A small LRU cache of open (read-only) netCDF4 Datasets
+
+    Shared by NetCDFFile objects created with cache=True, so that repeated
+    queries against the same file only open it once. A cached handle is
+    reopened if the file has been modified since it was opened, and the
+    least recently used handle is closed once there are more than
+    'maxsize' files open.
+
+    Every get() pins the handle until it is given back with release(), and
+    a pinned handle is never closed: if it has to leave the cache (evicted,
+    replaced by a newer version of the file, or clear()) it is closed on
+    its last release instead. Pinned handles can push the number of open
+    files over 'maxsize' for as long as they are in use.
+    """
+
+    def __init__(self, maxsize=16):
+
+        self.maxsize = maxsize
+        self._handles = OrderedDict()
+        self._refs = dict()
+        self._retired = dict()
+        self._lock = threading.Lock()
+
+    def _retire(self, D):
+        """Close D now, or on its last release if it is still in use"""
+
+        if id(D) in self._refs:
+            self._retired[id(D)] = D
+        else:
+            D.close()
+
+    def _evict(self):
+        """Close the least recently used handles that aren't in use"""
+
+        extra = len(self._handles) - self.maxsize
+        for path in list(self._handles.keys()):
+            if extra <= 0:
+                break
+            D, _ = self._handles[path]
+            if id(D) not in self._refs:
+                del self._handles[path]
+                D.close()
+                extra -= 1
+
+    def get(self, path):
+        """Return an open Dataset for path, pinned until release() is called"""
+
+        mtime = os.stat(path).st_mtime
+
+        with self._lock:
+            if path in self._handles:
+                D, opened = self._handles.pop(path)
+                if opened == mtime and D.isopen():
+                    self._handles[path] = (D, opened)
+                    self._refs[id(D)] = self._refs.get(id(D), 0) + 1
+                    return D
+                self._retire(D)
+
+            D = Dataset(path, 'r')
+            self._handles[path] = (D, mtime)
+            self._refs[id(D)] = 1
+
+            self._evict()
+
+        return D
+
+    def release(self, D):
+        """Give back a Dataset returned by get()"""
+
+        with self._lock:
+            n = self._refs.pop(id(D), 0) - 1
+            if n > 0:
+                self._refs[id(D)] = n
+            elif id(D) in self._retired:
+                self._retired.pop(id(D)).close()
+
+            self._evict()
+
+    def clear(self):
+        """Close every cached Dataset (those in use once they are released)"""
+
+        with self._lock:
+            for D, _ in self._handles.values():
+                self._retire(D)
+            self._handles.clear()
+
+
+dataset_cache = DatasetCache()
+
+
 class NetCDFFile(object):
     """Sets up the NetCDFFile object class
 
@@ -179,9 +733,26 @@ class NetCDFFile(object):
         Required:
 
         -   ncfile (str): the full filepath of the netCDF file.
+
+        Optional:
+
+        -   header (dict): the cached header of the file, as returned by
+                toolbox.fileIO.ncindex. If given, variable names and
+                descriptions are taken from it instead of the file.
+
+        -   cache (bool): keep the file open in the module-level
+                dataset_cache, shared with other NetCDFFile objects,
+                instead of opening and closing it on every call.
+
+    The object can also be used as a context manager, which keeps a single
+    handle open for everything done inside the 'with' block:
+
+        with NetCDFFile(f) as nc:
+            nc.print_vars()
+            df = nc.get_vars('concentration')
     """
 
-    def __init__(self, ncfile):
+    def __init__(self, ncfile, header=None, cache=False):
 
         if not isinstance(ncfile, str):
             raise TypeError('ncfile MUST be a string')
@@ -190,12 +761,60 @@ class NetCDFFile(object):
             raise IOError('ncfile does not exist on disk')
 
         self.abspath = os.path.abspath(ncfile)
+        self.header = header
+        self.cache = cache
+
+        self._handle = None
+        self._owned = False
+
+    def open(self):
+        """Open the file and keep it open until close() is called"""
+
+        if self._handle is None:
+            if self.cache:
+                self._handle, self._owned = dataset_cache.get(self.abspath), False
+            else:
+                self._handle, self._owned = Dataset(self.abspath, 'r'), True
+
+        return self
+
+    def close(self):
+
+        if self._handle is not None:
+            if self._owned:
+                self._handle.close()
+            else:
+                dataset_cache.release(self._handle)
+
+        self._handle = None
+        self._owned = False
+
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, *args):
+        self.close()
+
+    @contextmanager
+    def _open(self):
+        """Yield an open Dataset, reusing the current handle if there is one"""
+
+        if self._handle is not None:
+            yield self._handle
+        else:
+            self.open()
+            try:
+                yield self._handle
+            finally:
+                self.close()
 
     def get_keys(self):
 
-        with Dataset(self.abspath, 'r') as D:
-            keys = D.variables.keys()
-            keys.sort()
+        if self.header is not None:
+            return sorted(self.header['variables'].keys())
+
+        with self._open() as D:
+            keys = sorted(D.variables.keys())
 
         return keys
 
@@ -206,69 +825,63 @@ class NetCDFFile(object):
            just set return_dict to True
         """
 
-        # open the file for reading
-        with Dataset(self.abspath, 'r') as D:
+        variables = dict()
 
-            variables = dict()
+        if self.header is not None:
+            for k, v in self.header['variables'].items():
+                variables[k] = dict(long_name=v['long_name'], units=v['units'],
+                                    dimensions=tuple(v['dimensions']))
 
-            # iterate through the keys
-            for k in self.get_keys():
+        else:
+            # open the file for reading
+            with self._open() as D:
+
+                # iterate through the keys
+                for k in self.get_keys():
 
-                long_name, units, dimensions = "None", "None", "None"
+                    long_name, units, dimensions = "None", "None", "None"
 
-                if hasattr(D.variables[k], "long_name"):  # check if it has the 'long_name' attribute
-                    long_name = getattr(D.variables[k], "long_name")
+                    if hasattr(D.variables[k], "long_name"):  # check if it has the 'long_name' attribute
+                        long_name = getattr(D.variables[k], "long_name")
 
-                if hasattr(D.variables[k], "units"):  # check if it has the 'units' attribute
-                    units = getattr(D.variables[k], "units")
+                    if hasattr(D.variables[k], "units"):  # check if it has the 'units' attribute
+                        units = getattr(D.variables[k], "units")
 
-                if hasattr(D.variables[k], "dimensions"):  # check if it has the 'dimensions' attribute
-                    dimensions = getattr(D.variables[k], "dimensions")
+                    if hasattr(D.variables[k], "dimensions"):  # check if it has the 'dimensions' attribute
+                        dimensions = getattr(D.variables[k], "dimensions")
 
-                # save all these attributes into the 'variable' dictionary, keyed on the actual variable name
-                variables[k] = dict(long_name=long_name, dimensions=dimensions, units=units)
+                    # save all these attributes into the 'variable' dictionary, keyed on the actual variable name
+                    variables[k] = dict(long_name=long_name, dimensions=dimensions, units=units)
 
-                # print out the formatted string
-                print("{}\n\tlong name: {}\n\tdimensions: {}\n\tunits: {}".
-                      format(k, long_name, dimensions, units))
+        # print out the formatted string
+        for k in sorted(variables.keys()):
+            print("{}\n\tlong name: {}\n\tdimensions: {}\n\tunits: {}".
+                  format(k, variables[k]['long_name'], variables[k]['dimensions'],
+                         variables[k]['units']))
 
         if return_dict:
             return variables
         else:
             return
 
+    def variable_index(self):
+        """Return the (shared) VariableIndex for this file's variables"""
+
+        if self.header is not None and 'schema' in self.header:
+            return VariableIndex.for_keys(self.get_keys(), schema=self.header['schema'])
+
+        return VariableIndex.for_keys(self.get_keys())
+
     def _parse_variable_list(self, varlist, exclude, **kwargs):
         """Parse the netCDF variable list"""
 
         # make sure that varlist is of type list, tuple, or string
-        if not isinstance(varlist, (list, tuple, str)):
+        if isinstance(varlist, str) or hasattr(varlist, 'search'):
+            varlist = [varlist]
+        elif not isinstance(varlist, (list, tuple)):
             raise TypeError("What did you just try and pass? It's not okay.")
 
-        _keys = self.get_keys()
-        _master_list = []
-
-        def _parse_string(ky, s, e):
-            if not isinstance(s, str):
-                raise TypeError("Hey, {} is not a string".format(s))
-
-            if s in ky:
-                if s not in _master_list:
-                    _master_list.append(s)
-            elif np.any([s in k for k in ky]):
-                [_master_list.append(k) for k in ky if s in k and k not in _master_list and exclude not in k]
-            else:
-                warnings.warn('Warning: {} not found in varlist'.format(s), VariableWarning)
-
-            return
-
-        if isinstance(varlist, str):
-            _parse_string(_keys, varlist, exclude)
-
-        elif isinstance(varlist, (list, tuple)):
-            for l in varlist:
-                _parse_string(_keys, l, exclude)
-        else:
-            print('UP UP DOWN DOWN LEFT RIGHT LEFT RIGHT B A START')
+        _master_list = self.variable_index().resolve(varlist, exclude)
 
         ignore_empty = kwargs.pop('ignore_empty', False)
 
@@ -287,6 +900,44 @@ class NetCDFFile(object):
         else:
             return False
 
+    def _time_slice(self, D, start=None, end=None, stride=None):
+        """Translate a time window into an index slice on the time dimension
+
+        Only the raw (numeric) time values are read to do this, and they
+        are assumed to be increasing.
+        """
+
+        if stride is not None and (not isinstance(stride, int) or stride < 1):
+            raise TypeError('stride must be a positive integer')
+
+        if (start is None and end is None) or 'time' not in D.variables:
+            return slice(None, None, stride)
+
+        t = D.variables['time']
+        calendar = getattr(t, 'calendar', 'standard')
+        times = t[:]
+
+        i0, i1 = 0, len(times)
+        if start is not None:
+            i0 = np.searchsorted(times, date2num(pd.Timestamp(start).to_pydatetime(),
+                                                 t.units, calendar), 'left')
+        if end is not None:
+            i1 = np.searchsorted(times, date2num(pd.Timestamp(end).to_pydatetime(),
+                                                 t.units, calendar), 'right')
+
+        return slice(int(i0), int(i1), stride)
+
+    def _read_variable(self, v, tslice):
+        """Read a variable, applying tslice along its time dimension"""
+
+        if not self._check_time_dimension(v) or tslice == slice(None):
+            return v[:]
+
+        index = [slice(None)] * len(v.dimensions)
+        index[v.dimensions.index('time')] = tslice
+
+        return v[tuple(index)]
+
     def get_vars(self, varlist=None, exclude=None, **kwargs):
         """Return data from the netCDF file as a Pandas object if possible
 
@@ -304,6 +955,16 @@ class NetCDFFile(object):
                 contain all strings. Same rules apply to strings
                 inside of lists and tuples.
 
+        Optional:
+        -  start, end (datetime, str)
+                only read the part of the time dimension between
+                start and end (inclusive). The time window is turned
+                into an index range before anything is read, so only
+                that slab comes off the disk.
+
+        -  stride (int)
+                only read every stride-th time step.
+
         Returns:
 
         -  Pandas DataFrame or dict()
@@ -324,25 +985,32 @@ class NetCDFFile(object):
             if not isinstance(resample, str):
                 raise TypeError("resample must be of type string")
 
-        vl = self._parse_variable_list(varlist, exclude, **kwargs)
+        start = kwargs.pop('start', None)
+        end = kwargs.pop('end', None)
+        stride = kwargs.pop('stride', None)
+
+        # a single open for both the variable lookup and the read
+        with self._open() as D:
+            vl = self._parse_variable_list(varlist, exclude, **kwargs)
 
-        if vl is None:
-            return None
+            if vl is None:
+                return None
 
-        mapping = kwargs.pop('mapping', None)
+            mapping = kwargs.pop('mapping', None)
 
-        with Dataset(self.abspath, 'r') as D:
             time_dim = np.array([self._check_time_dimension(D.variables[v]) for v in vl])
+            tslice = self._time_slice(D, start, end, stride)
 
             data = dict()
 
             if 'time' in D.variables.keys() and time_dim.all():
-                dt = num2date(D.variables['time'][:], D.variables['time'].units)
+                t = D.variables['time']
+                dt = decode_times(t[tslice], t.units, getattr(t, 'calendar', 'standard'))
                 for v in vl:
                     if mapping is None:
-                        data[v] = D.variables[v][:]#.astype(np.float)
+                        data[v] = self._read_variable(D.variables[v], tslice)#.astype(np.float)
                     elif isinstance(mapping, dict):
-                        data[mapping[v]] = D.variables[v][:]#.astype(np.float)
+                        data[mapping[v]] = self._read_variable(D.variables[v], tslice)#.astype(np.float)
                     else:
                         return None
 
@@ -356,8 +1024,8 @@ class NetCDFFile(object):
 
                 for v in vl:
                     if mapping is None:
-                        data[v] = D.variables[v][:]
+                        data[v] = self._read_variable(D.variables[v], tslice)
                     elif isinstance(mapping, dict):
-                        data[mapping[v]] = D.variables[v][:]
+                        data[mapping[v]] = self._read_variable(D.variables[v], tslice)
 
                 return data
@@ -0,0 +1,111 @@
+__author__ = 'Jayson Stemmler'
+__created__ = "10/18/26 11:40 AM"
+
+"""
+    Fast decoding of CF-style netCDF time variables.
+
+    netCDF4.num2date hands back an array of datetime objects, one Python
+    object per sample, which pandas then has to parse all over again.
+    For the usual "<units> since <reference date>" time axes the same
+    thing can be done with integer arithmetic on datetime64[ns] arrays.
+"""
+
+import re
+import numpy as np
+
+from netCDF4 import num2date
+
+_UNITS = re.compile(r'^\s*(\w+)\s+since\s+'
+                    r'(\d{1,4})-(\d{1,2})-(\d{1,2})'
+                    r'(?:[ T](\d{1,2}):(\d{1,2})(?::(\d{1,2}(?:\.\d*)?))?)?'
+                    r'\s*(Z|UTC|GMT|[+-]?\d{1,2}(?::?\d{2})?)?\s*$', re.IGNORECASE)
+
+_NS_PER_UNIT = dict()
+for _names, _ns in [(('days', 'day', 'd'), 86400 * 10**9),
+                    (('hours', 'hour', 'hrs', 'hr', 'h'), 3600 * 10**9),
+                    (('minutes', 'minute', 'mins', 'min'), 60 * 10**9),
+                    (('seconds', 'second', 'secs', 'sec', 's'), 10**9),
+                    (('milliseconds', 'millisecond', 'msecs', 'msec', 'ms'), 10**6),
+                    (('microseconds', 'microsecond', 'usecs', 'usec', 'us'), 10**3)]:
+    for _name in _names:
+        _NS_PER_UNIT[_name] = _ns
+
+_CALENDARS = ('standard', 'gregorian', 'proleptic_gregorian')
+
+
+def _parse_units(units):
+    """Return (nanoseconds per unit, reference time in ns) or None"""
+
+    match = _UNITS.match(units)
+    if match is None:
+        return None
+
+    unit, year, month, day, hour, minute, second, tz = match.groups()
+
+    scale = _NS_PER_UNIT.get(unit.lower())
+    if scale is None:
+        return None
+
+    second = float(second or 0)
+    ref = np.datetime64('{:04d}-{:02d}-{:02d}T{:02d}:{:02d}:{:02d}'
+                        .format(int(year), int(month), int(day), int(hour or 0),
+                                int(minute or 0), int(second)), 'ns').astype(np.int64)
+    ref += int(round((second - int(second)) * 10**9))
+
+    # ARM writes the offset as e.g. "0:00", bring the reference to UTC
+    if tz is not None and tz.upper() not in ('Z', 'UTC', 'GMT'):
+        sign = -1 if tz.startswith('-') else 1
+        hh, _, mm = tz.lstrip('+-').partition(':')
+        if not mm and len(hh) > 2:
+            hh, mm = hh[:-2], hh[-2:]
+        ref -= sign * (int(hh) * 3600 + int(mm or 0) * 60) * 10**9
+
+    return scale, ref
+
+
+def decode_times(values, units, calendar='standard'):
+    """Convert numeric CF times to a datetime64[ns] array
+
+    Does the same job as netCDF4.num2date, but with array arithmetic
+    instead of building a datetime object per sample.
+
+    -   values (array)
+            the raw time values, e.g. D.variables['time'][:]. Masked or
+            non-finite values come out as NaT.
+
+    -   units (str)
+            CF units string, e.g. "seconds since 2014-03-15 00:00:06 0:00"
+
+    -   calendar (str)
+            only the standard calendars can be done this way, anything
+            else is handed off to num2date.
+    """
+
+    parsed = _parse_units(units)
+
+    if parsed is None or str(calendar).lower() not in _CALENDARS:
+        return np.array(num2date(values, units, calendar), dtype='datetime64[ns]')
+
+    scale, ref = parsed
+
+    bad = np.ma.getmaskarray(values)
+    values = np.ma.getdata(values)
+
+    if np.issubdtype(values.dtype, np.integer):
+        ns = values.astype(np.int64) * scale
+    else:
+        v = values.astype(np.float64)
+        bad = bad | ~np.isfinite(v)
+        v = np.where(bad, 0., v)
+
+        # keep the whole and fractional parts apart so that large offsets
+        # don't lose precision going through float nanoseconds
+        whole = np.floor(v)
+        ns = whole.astype(np.int64) * scale + np.round((v - whole) * scale).astype(np.int64)
+
+    out = (ns + ref).view('datetime64[ns]')
+
+    if bad.any():
+        out = np.where(bad, np.datetime64('NaT'), out)
+
+    return out
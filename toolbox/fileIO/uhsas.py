@@ -4,43 +4,196 @@ __author__ = 'Jayson Stemmler'
 __created__ = "8/17/15 8:10 AM"
 
 import os
+import warnings
 
-from netCDF4 import Dataset, num2date
+from netCDF4 import Dataset
 import matplotlib.pyplot as plt
 import matplotlib.cm as cm
 import numpy as np
+import pandas as pd
+
+from ..tools import pmap
+from .netCDF import NetCDFFolder, FileReadWarning
+from .times import decode_times
 
 class UHSAS(object):
+    """A single UHSAS file, with the size distribution left on disk
+
+    The size distribution (time x 99 bins) is only read when it's needed,
+    and then in chunks of rows, so concentrations and plots work on files
+    that are too big to hold in memory.
+
+    Arguments
+    ---------------------
+
+        Required:
+
+        -   filepath (str): UHSAS netCDF file
+
+        Optional:
+
+        -   cache (str)
+                folder for a .npy copy of the size distribution. The copy
+                is made the first time the distribution is read (one
+                chunk at a time) and after that it's memory-mapped, which
+                is a lot faster than going through netCDF again. It's
+                remade if the netCDF file is newer.
+
+        -   chunk (int)
+                number of time steps read at a time
+    """
 
-    def __init__(self, filepath):
+    def __init__(self, filepath, cache=None, chunk=3600):
 
         if not isinstance(filepath, str):
             raise TypeError("'filepath' must be a string")
 
-        uhsas_file = os.path.abspath(filepath)
+        self.filepath = os.path.abspath(filepath)
+        self.cache = cache
+        self.chunk = chunk
+        self._total_concentration = None
+        self._size_distribution = None
 
-        with Dataset(uhsas_file, 'r') as F:
+        with Dataset(self.filepath, 'r') as F:
 
-            self.datetimes = num2date(F.variables['time'][:], F.variables['time'].units)
-            self.hour = np.array([d.hour for d in self.datetimes])
+            self.datetimes = pd.DatetimeIndex(decode_times(F.variables['time'][:],
+                                                           F.variables['time'].units))
+            self.hour = np.asarray(self.datetimes.hour)
 
-            self.size_distribution = F.variables['size_distribution'][:]
-            self.total_concentration = ((self.size_distribution.sum(axis=1)) /
-                                        ((F.variables['sampling_volume'][:] / 60) * 10))
             self.sampling_volume = F.variables['sampling_volume'][:]
             self.lower_size_limit = F.variables['lower_size_limit'][:]
             self.upper_size_limit = F.variables['upper_size_limit'][:]
 
             self.time = F.variables['time'][:]
 
+    def _cache_file(self):
+
+        name = os.path.splitext(os.path.basename(self.filepath))[0]
+        return os.path.join(self.cache, name + '.size_distribution.npy')
+
+    def _memmap(self):
+        """Memory-mapped copy of the size distribution, made if needed"""
+
+        npy = self._cache_file()
+
+        if not os.path.isfile(npy) or os.path.getmtime(npy) < os.path.getmtime(self.filepath):
+
+            if not os.path.isdir(self.cache):
+                os.makedirs(self.cache)
+
+            tmp = npy + '.tmp'
+            with Dataset(self.filepath, 'r') as F:
+                sd = F.variables['size_distribution']
+                out = np.lib.format.open_memmap(tmp, mode='w+', dtype=np.float32, shape=sd.shape)
+                for i in range(0, sd.shape[0], self.chunk):
+                    out[i:i + self.chunk] = np.ma.filled(np.ma.asarray(sd[i:i + self.chunk],
+                                                                       dtype=np.float32), np.nan)
+                out.flush()
+                del out
+
+            os.rename(tmp, npy)
+
+        return np.load(npy, mmap_mode='r')
+
+    def iter_chunks(self, chunk=None):
+        """Yield (rows, block) pieces of the size distribution in time order
+
+        rows is a slice of the time axis and block the float array of
+        counts for it, with missing values as NaN.
+        """
+
+        chunk = chunk or self.chunk
+
+        if self.cache is not None:
+            sd = self._memmap()
+            for i in range(0, sd.shape[0], chunk):
+                yield slice(i, min(i + chunk, sd.shape[0])), np.asarray(sd[i:i + chunk])
+            return
+
+        with Dataset(self.filepath, 'r') as F:
+            sd = F.variables['size_distribution']
+            for i in range(0, sd.shape[0], chunk):
+                block = np.ma.filled(np.ma.asarray(sd[i:i + chunk], dtype=np.float32), np.nan)
+                yield slice(i, i + len(block)), block
+
+    @property
+    def size_distribution(self):
+        """The whole size distribution (memory-mapped if there's a cache)
+
+        Read on first access and kept after that.
+        """
+
+        if self._size_distribution is None:
+            if self.cache is not None:
+                self._size_distribution = self._memmap()
+            else:
+                with Dataset(self.filepath, 'r') as F:
+                    self._size_distribution = F.variables['size_distribution'][:]
+
+        return self._size_distribution
+
+    @property
+    def total_concentration(self):
+
+        if self._total_concentration is None:
+            self._total_concentration = self.concentration(None)
+
+        return self._total_concentration
+
+    def _llim_mask(self, llim):
+        """Size bins at or above llim (all of them for None)"""
+
+        if llim is None:
+            return slice(None)
+
+        return self.lower_size_limit >= llim
+
     def concentration(self, llim, sample_rate=10):
+        """Concentration of particles at or above llim (None for all bins)"""
 
-        mask = self.lower_size_limit >= llim
-        masked_dist = self.size_distribution[:, mask]
+        mask = self._llim_mask(llim)
 
-        return masked_dist.sum(axis=1) / ((self.sampling_volume / 60) * sample_rate)
+        counts = np.empty(len(self.time))
+        for rows, block in self.iter_chunks():
+            counts[rows] = np.nansum(block[:, mask], axis=1)
 
-    def plot(self, savefile=None, **kwargs):
+        return counts / ((self.sampling_volume / 60) * sample_rate)
+
+    def block_average(self, max_steps=1440):
+        """Size distribution averaged down to at most max_steps time steps
+
+        Returns (edges, dist), with edges the max_steps + 1 time edges of
+        the averaged steps and dist the (steps x bins) mean counts. Only
+        one chunk is held in memory at a time.
+        """
+
+        n = len(self.time)
+        step = max(1, int(np.ceil(n / max_steps)))
+        chunk = max(step, self.chunk // step * step)
+
+        parts = []
+        for rows, block in self.iter_chunks(chunk):
+            nb = int(np.ceil(len(block) / step))
+            padded = np.full((nb * step, block.shape[1]), np.nan, dtype=block.dtype)
+            padded[:len(block)] = block
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore', RuntimeWarning)
+                parts.append(np.nanmean(padded.reshape(nb, step, -1), axis=1))
+
+        dist = np.concatenate(parts) if len(parts) else np.empty((0, len(self.lower_size_limit)))
+        edges = self.datetimes[::step].append(self.datetimes[-1:])
+
+        return edges, dist
+
+    def plot(self, savefile=None, max_steps=1440, **kwargs):
+        """Plot the size distribution and total concentration
+
+        The distribution is block averaged down to at most max_steps time
+        steps first (see block_average), which is all a figure can show
+        anyway.
+        """
+
+        edges, dist = self.block_average(max_steps)
 
         fig = plt.figure(figsize=(12, 7))
 
@@ -48,11 +201,11 @@ class UHSAS(object):
 
         cmap = kwargs.pop("cmap", cm.Spectral_r)
         vmin = kwargs.pop("vmin", 0)
-        vmax = kwargs.pop("vmax", np.percentile(self.size_distribution, 99))
+        vmax = kwargs.pop("vmax", np.nanpercentile(dist, 99))
 
-        image = ax.pcolormesh(self.datetimes,
+        image = ax.pcolormesh(edges,
                               np.array(self.lower_size_limit.tolist()+[self.upper_size_limit[-1]]),
-                              self.size_distribution.T,
+                              np.ma.masked_invalid(dist.T),
                               vmin=vmin,
                               vmax=vmax,
                               cmap=cmap,
@@ -113,6 +266,333 @@ class UHSAS(object):
         return fig, (ax, ax2)
 
 
+def _parse_stats(stats):
+    """Turn e.g. ('mean', 'median', 25, 75) into (label, percentile) pairs"""
+
+    parsed = []
+    for st in stats:
+        if st == 'mean':
+            parsed.append(('mean', None))
+        elif st == 'median':
+            parsed.append(('median', 50.))
+        elif isinstance(st, (int, float)) and 0 <= st <= 100:
+            parsed.append(('p{:g}'.format(st), float(st)))
+        else:
+            raise ValueError("stats must be 'mean', 'median', or percentiles from 0 to 100")
+
+    return parsed
+
+
+def _binned_stats(block, bins, stats):
+    """Per size bin statistics of the rows of block, for each time bin
+
+    block is (rows x size bins) with NaN for missing values, bins the
+    time bin of each row, and stats the parsed (label, percentile) list.
+    All time bins are done at once: the rows are laid out as a
+    (time bins x rows per bin x size bins) cube padded with NaN, sorted
+    along the rows so the NaN end up last, and the percentiles are picked
+    out of it by the number of valid values in each column.
+
+    Returns (labels, dict of label -> (time bins x size bins) arrays).
+    """
+
+    order = np.argsort(bins, kind='mergesort')
+    block, bins = block[order], bins[order]
+
+    labels, starts, counts = np.unique(bins, return_index=True, return_counts=True)
+    width = np.arange(counts.max())
+
+    cube = block[np.minimum(starts[:, np.newaxis] + width, len(block) - 1)].astype(np.float64)
+    cube[width >= counts[:, np.newaxis]] = np.nan
+    cube.sort(axis=1)
+
+    n = (~np.isnan(cube)).sum(axis=1)
+    empty = n == 0
+
+    out = dict()
+    with np.errstate(invalid='ignore', divide='ignore'):
+        for label, q in stats:
+            if q is None:
+                out[label] = np.nansum(cube, axis=1) / n
+                continue
+
+            pos = q / 100. * np.maximum(n - 1, 0)
+            lo = np.floor(pos).astype(np.intp)
+            hi = np.minimum(lo + 1, np.maximum(n - 1, 0))
+            a = np.take_along_axis(cube, lo[:, np.newaxis, :], axis=1)[:, 0]
+            b = np.take_along_axis(cube, hi[:, np.newaxis, :], axis=1)[:, 0]
+
+            value = a + (b - a) * (pos - lo)
+            value[empty] = np.nan
+            out[label] = value
+
+    return labels, out
+
+
+def _first_time(files, start=None, end=None):
+    """First time stamp inside [start, end] of time-ordered UHSAS files
+
+    Only the time variables are read. Files that can't be read are skipped
+    here (aggregate reports them). Returns None if there's no data.
+    """
+
+    for f in files:
+        try:
+            with Dataset(f, 'r') as F:
+                times = pd.DatetimeIndex(decode_times(F.variables['time'][:],
+                                                      F.variables['time'].units))
+        except Exception:
+            continue
+
+        times = times[~pd.isnull(times)]
+        if start is not None:
+            times = times[times >= start]
+        if end is not None:
+            times = times[times <= end]
+
+        if len(times):
+            return times.min()
+
+    return None
+
+
+def _aggregate_file(args):
+    """Bin statistics for one UHSAS file (a pmap job)
+
+    Time bins are 'step' nanoseconds long, counted from 'origin' (both
+    int64), and every row is read once: the size bin statistics and the
+    concentration above each llim all come out of the same chunk pass.
+    Time bins that are wholly inside the file are reduced here. The first
+    and last bins may carry on into the neighbouring files, so their raw
+    rows are handed back to be combined with those of the other files.
+    Returns a (filename, result, error) tuple like netCDF._read_file.
+    """
+
+    f, step, origin, stats, llims, cache, chunk, start, end = args
+
+    try:
+        U = UHSAS(f, cache=cache, chunk=chunk)
+
+        t = U.datetimes.values.astype('datetime64[ns]').view(np.int64)
+        bins = origin + (t - origin) // step * step
+        keep = ~np.asarray(pd.isnull(U.datetimes))
+        if start is not None:
+            keep &= np.asarray(U.datetimes >= start)
+        if end is not None:
+            keep &= np.asarray(U.datetimes <= end)
+
+        masks = [U._llim_mask(llim) for llim in llims]
+        counts = np.empty((len(llims), len(t)))
+
+        complete = []
+        edges = dict()
+        carry_block, carry_bins = None, None
+
+        for rows, block in U.iter_chunks():
+            for i, mask in enumerate(masks):
+                counts[i, rows] = np.nansum(block[:, mask], axis=1)
+
+            k = keep[rows]
+            block, b = block[k], bins[rows][k]
+
+            if carry_block is not None:
+                block = np.concatenate([carry_block, block])
+                b = np.concatenate([carry_bins, b])
+
+            if not len(b):
+                continue
+
+            # the last bin may go on in the next chunk
+            done = b != b[-1]
+            carry_block, carry_bins = block[~done], b[~done]
+            block, b = block[done], b[done]
+
+            if len(b) and not len(edges):
+                first = b == b[0]
+                edges[b[0]] = block[first]
+                block, b = block[~first], b[~first]
+
+            if len(b):
+                complete.append(_binned_stats(block, b, stats))
+
+        if carry_bins is not None and len(carry_bins):
+            edges[carry_bins[0]] = carry_block
+
+        # same as UHSAS.concentration, for every llim at once
+        volume = (np.ma.asarray(U.sampling_volume, dtype=float) / 60) * 10
+        concentrations = np.ma.filled(counts / volume, np.nan)
+
+        conc = dict()
+        for llim, c in zip(llims, concentrations):
+            grouped = pd.Series(c[keep], index=bins[keep]).groupby(level=0)
+
+            # the total is the same as the concentration above the smallest bin
+            label = float(U.lower_size_limit[0] if llim is None else llim)
+            conc[('sum', label)] = grouped.sum()
+            conc[('count', label)] = grouped.count()
+
+        result = dict(sizes=np.asarray(U.lower_size_limit), complete=complete,
+                      edges=edges, concentration=pd.DataFrame(conc))
+
+        return f, result, None
+
+    except Exception as e:
+        return f, None, e
+
+
+def _reduce_edge(b, rows, stats):
+    """_binned_stats for a single time bin b split over several files"""
+
+    block = np.concatenate(rows)
+
+    return _binned_stats(block, np.full(len(block), b, dtype=np.int64), stats)
+
+
+class UHSASFolder(NetCDFFolder):
+    """A folder of UHSAS files, reduced to binned statistics
+
+    Finds the files the same way as NetCDFFolder (including the start and
+    end time window), and adds aggregate() to boil a whole campaign of
+    1-second size distributions down to statistics per time bin without
+    ever holding more than a few files' worth in memory.
+
+    Takes the same arguments as NetCDFFolder, plus:
+
+        -   cache (str)
+                folder for the memory-mapped size distributions, see UHSAS
+    """
+
+    def __init__(self, folder, pat=None, cache=None, **kwargs):
+
+        super(UHSASFolder, self).__init__(folder, pat=pat, **kwargs)
+        self.cache = cache
+
+    def aggregate(self, rule='1H', stats=('mean', 'median', 25, 75), llims=(None,),
+                  chunk=3600, workers=None, executor=None, savefile=None, key='uhsas'):
+        """Statistics of the size distribution in time bins
+
+        Arguments
+        ---------------------
+
+            Optional:
+
+            -   rule (str)
+                    fixed-length pandas offset alias for the time bins,
+                    e.g. '10min', '1H', or '1D'. Bins start at midnight
+                    of the first day of data, as with pandas resample.
+
+            -   stats (list)
+                    any of 'mean', 'median', and percentiles (numbers
+                    from 0 to 100), worked out for every size bin.
+                    Missing values are left out.
+
+            -   llims (list)
+                    lower size limits for the mean concentration in each
+                    time bin (see UHSAS.concentration). None is the total
+                    concentration, labelled with the smallest lower size
+                    limit.
+
+            -   chunk (int)
+                    time steps read at a time. A time bin longer than a
+                    chunk is held in memory until it is done.
+
+            -   workers, executor
+                    see toolbox.tools.pmap. Each file is done by a
+                    single worker, in a process pool by default.
+
+            -   savefile (str)
+                    also write the result to this HDF5 file, under 'key'
+
+        Returns a DataFrame with one row per time bin and two column
+        levels: the statistic ('mean', 'median', 'p25', ..., and
+        'concentration') and the size bin (lower size limit) or llim.
+
+        The files are taken to be one datastream in time order (ARM
+        filenames sort that way). A time bin split between files is
+        reduced as soon as the next file has moved past it, so only the
+        raw rows of the one bin still open are kept between files.
+        """
+
+        stats = _parse_stats(stats)
+        llims = list(llims)
+
+        self.failed = dict()
+
+        first = _first_time(self.filelist, self.start, self.end)
+        if first is None:
+            origin = 0
+        else:
+            origin = int(np.datetime64(first.floor('D'), 'ns').astype(np.int64))
+        step = pd.tseries.frequencies.to_offset(rule).nanos
+
+        args = [(f, step, origin, stats, llims, self.cache, chunk, self.start, self.end)
+                for f in self.filelist]
+
+        sizes = None
+        labels, parts = [], []
+        open_bin, open_rows = None, []
+        conc = []
+
+        for f, result, err in pmap(_aggregate_file, args, workers=workers, executor=executor):
+            if err is not None:
+                self.failed[f] = err
+                warnings.warn('Could not read {}: {}'.format(os.path.basename(f), err),
+                              FileReadWarning)
+                continue
+
+            if sizes is None:
+                sizes = result['sizes']
+
+            for lab, values in result['complete']:
+                labels.append(lab)
+                parts.append(values)
+
+            # bins split between files: every edge bin of this file but the
+            # last one is done, as is any earlier bin still open
+            for b in sorted(result['edges']):
+                if open_bin is not None and b != open_bin:
+                    lab, values = _reduce_edge(open_bin, open_rows, stats)
+                    labels.append(lab)
+                    parts.append(values)
+                    open_rows = []
+
+                open_bin = b
+                open_rows.append(result['edges'][b])
+
+            conc.append(result['concentration'])
+
+        if sizes is None:
+            return pd.DataFrame()
+
+        if open_bin is not None:
+            lab, values = _reduce_edge(open_bin, open_rows, stats)
+            labels.append(lab)
+            parts.append(values)
+
+        index = pd.DatetimeIndex(np.concatenate(labels).astype('datetime64[ns]'))
+        columns = pd.MultiIndex.from_product([[label for label, q in stats], sizes],
+                                             names=['stat', 'size'])
+        data = np.hstack([np.concatenate([p[label] for p in parts]) for label, q in stats])
+
+        result = pd.DataFrame(data, index=index, columns=columns).sort_index()
+
+        totals = pd.concat(conc).groupby(level=0).sum()
+        mean_conc = totals['sum'] / totals['count']
+        mean_conc.index = pd.DatetimeIndex(mean_conc.index.values.astype('datetime64[ns]'))
+        mean_conc.columns = pd.MultiIndex.from_product([['concentration'], mean_conc.columns],
+                                                       names=['stat', 'size'])
+
+        result = result.join(mean_conc, how='outer')
+
+        # fill in empty bins, like pandas resample does
+        result = result.reindex(pd.date_range(result.index[0], result.index[-1], freq=rule))
+
+        if savefile is not None:
+            result.to_hdf(savefile, key=key)
+
+        return result
+
+
 if __name__ == "__main__":
 
     file = '/Volumes/NiftyDrive/Research/data/ENA/uhsas/aos/enaaosuhsasC1.a1.20140315.000006.cdf'
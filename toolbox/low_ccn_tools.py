@@ -15,11 +15,171 @@ __created__ = "6/5/15 7:49 AM"
 import matplotlib.pyplot as plt
 import pandas as pd
 import numpy as np
-from datetime import timedelta as delt
-from .plotting.windrose import windrose
+from .plotting.windrose import windrose, BinningPlan
 from .plotting.series import filled_series
 
+class CCNPartition(object):
+    """CCN data split up by supersaturation setpoint, once
+
+    The CCN record is sorted by supersaturation (keeping the time order
+    within each setpoint) so that every setpoint is one contiguous slice
+    of a single array. Picking out a setpoint, listing the setpoints and
+    the per-setpoint statistics are then lookups instead of scans over
+    the whole record. Build it once and hand it to every LowCCN with
+    partition=..., or save it to HDF5 and load it next time.
+
+    Arguments
+    ---------------------
+
+        Required:
+
+        -   ccn_data (DataFrame): CCN data with a DatetimeIndex
+
+        Optional:
+
+        -   ccn, ss (str): names of the CCN and supersaturation columns
+    """
+
+    def __init__(self, ccn_data, ccn='CCN', ss='SS'):
+
+        try:
+            ss_values = np.asarray(ccn_data[ss].values)
+            ccn_values = np.asarray(ccn_data[ccn].values, dtype=float)
+        except KeyError:
+            raise KeyError('Data Keys Not Found')
+
+        # keep the column's own float type (ARM files store SS as float32),
+        # so that setpoints match the way ccn_data[ss] == 0.1 would
+        if ss_values.dtype.kind != 'f':
+            ss_values = ss_values.astype(float)
+
+        order = np.argsort(ss_values, kind='mergesort')
+
+        self._build(ccn_data.index.values[order], ss_values[order], ccn_values[order], ccn)
+
+    def _build(self, times, ss, values, name):
+
+        self.name = name
+        self.times = np.asarray(times, dtype='datetime64[ns]')
+        self.ss = ss
+        self.values = values
+        self._stats = None
+
+        # NaN setpoints sort to the end, leave them out
+        valid = ~np.isnan(ss)
+        n = int(valid.sum())
+
+        bounds = np.append(np.append(0, np.flatnonzero(np.diff(ss[:n])) + 1), n)
+        self.setpoints = ss[bounds[:-1]] if n else ss[:0]
+        self._slices = dict((v, slice(a, b)) for v, a, b in
+                            zip(self.setpoints.tolist(), bounds[:-1], bounds[1:]))
+
+    def _key(self, setpoint):
+        """setpoint as stored, i.e. rounded to the type of the SS column"""
+        return np.asarray(setpoint, dtype=self.ss.dtype).item()
+
+    def __contains__(self, setpoint):
+        return self._key(setpoint) in self._slices
+
+    def get(self, setpoint):
+        """CCN time series at one setpoint (empty if it isn't there)"""
+
+        sl = self._slices.get(self._key(setpoint), slice(0, 0))
+
+        return pd.Series(self.values[sl], index=pd.DatetimeIndex(self.times[sl]), name=self.name)
+
+    def stats(self):
+        """count, mean, std, min, max, first and last time per setpoint"""
+
+        if self._stats is not None:
+            return self._stats
+
+        columns = ['count', 'mean', 'std', 'min', 'max', 'first', 'last']
+
+        if not len(self.setpoints):
+            self._stats = pd.DataFrame(columns=columns)
+            return self._stats
+
+        bounds = [self._slices[v] for v in self.setpoints.tolist()]
+        starts = np.array([sl.start for sl in bounds])
+        n = bounds[-1].stop
+        values = self.values[:n]
+        ok = ~np.isnan(values)
+
+        count = np.add.reduceat(ok.astype(int), starts)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = np.add.reduceat(np.where(ok, values, 0.), starts) / count
+            dev = np.where(ok, values - np.repeat(mean, np.diff(np.append(starts, n))), 0.)
+            std = np.sqrt(np.add.reduceat(dev * dev, starts) / (count - 1))
+
+        vmin = np.minimum.reduceat(np.where(ok, values, np.inf), starts)
+        vmax = np.maximum.reduceat(np.where(ok, values, -np.inf), starts)
+        vmin[count == 0] = np.nan
+        vmax[count == 0] = np.nan
+
+        t = self.times[:n].view(np.int64)
+        first = np.minimum.reduceat(t, starts).view('datetime64[ns]')
+        last = np.maximum.reduceat(t, starts).view('datetime64[ns]')
+
+        self._stats = pd.DataFrame(dict(zip(columns, [count, mean, std, vmin, vmax, first, last])),
+                                   index=pd.Index(self.setpoints, name='supersaturation'),
+                                   columns=columns)
+
+        return self._stats
+
+    def save(self, path, key='ccn_partition'):
+        """Write the partition to an HDF5 file"""
+
+        frame = pd.DataFrame({'SS': self.ss, self.name: self.values},
+                             index=pd.DatetimeIndex(self.times), columns=['SS', self.name])
+
+        with pd.HDFStore(path) as store:
+            store.put(key, frame)
+
+    @classmethod
+    def load(cls, path, key='ccn_partition'):
+        """Read a partition written by save(), without sorting again"""
+
+        with pd.HDFStore(path, mode='r') as store:
+            frame = store[key]
+
+        new = cls.__new__(cls)
+        name = frame.columns[1]
+        new._build(frame.index.values, frame['SS'].values,
+                   frame[name].values.astype(float), name)
+
+        return new
+
+
 class LowCCN(object):
+    """Low-CCN events: intervals where the mean CCN is at or below a threshold
+
+    Arguments
+    ---------------------
+
+        Required:
+
+        -   ccn_data (DataFrame): CCN data with a DatetimeIndex
+
+        Optional:
+
+        -   threshold (float): events are intervals <= threshold (20)
+
+        -   interval (str): resampling interval ('6H')
+
+        -   how (str): how the intervals are resampled ('mean')
+
+        -   supersaturation (float): setpoint to use (0.1)
+
+        -   ccn, ss (str): names of the CCN and supersaturation columns
+
+        -   partition (CCNPartition)
+                a partition of ccn_data, built once. Without one the
+                setpoint is picked out with a scan over the whole record,
+                which is fine for a single LowCCN. When making many of
+                them on the same data, build a CCNPartition once and pass
+                it to each: the setpoint is then a lookup.
+    """
 
     def __init__(self, ccn_data, **kwargs):
 
@@ -29,6 +189,7 @@ class LowCCN(object):
         supersat = kwargs.pop('supersaturation', 0.1)
         ccn_var = kwargs.pop('ccn', 'CCN')
         ss_var = kwargs.pop('ss', 'SS')
+        partition = kwargs.pop('partition', None)
 
         self.threshold = threshold
         self.supersaturation = supersat
@@ -41,7 +202,13 @@ class LowCCN(object):
             raise KeyError('Data Keys Not Found')
 
         self.data = ccn_data
-        self.ccn_subset = self.ccn[self.ss == supersat]
+
+        # with a shared partition the setpoint is a lookup, otherwise scan
+        self.partition = partition
+        if partition is None:
+            self.ccn_subset = self.ccn[self.ss == supersat]
+        else:
+            self.ccn_subset = partition.get(supersat)
 
         self.resampled = self.ccn_subset.resample(interval, how=how)
 
@@ -54,10 +221,16 @@ class LowCCN(object):
 
         print(self.data.describe())
 
-        ss_vals = set()
-        [ss_vals.add(i) for i in self.ss]
         print("\nUnique SuperSaturation Values:")
-        print(sorted(ss_vals))
+        if self.partition is None:
+            ss_vals = set()
+            [ss_vals.add(i) for i in self.ss]
+            print(sorted(ss_vals))
+        else:
+            print(self.partition.setpoints)
+
+            print("\nCCN by SuperSaturation:")
+            print(self.partition.stats())
 
         print("")
 
@@ -106,25 +279,387 @@ class LowCCN(object):
         return fig, ax
 
 
-def group_events(df, low, interval=6):
+class LowCCNMonitor(object):
+    """Incremental low-CCN event detection, one chunk of data at a time
+
+    Uses the same threshold/interval/supersaturation settings as LowCCN
+    (with how='mean'), but never needs more than the current interval in
+    memory, so it can follow a site as new files come in.
+
+    Arguments
+    ---------------------
+
+        Optional:
+
+        -   threshold, interval, supersaturation, ccn, ss
+                as for LowCCN
+
+        -   callback (function)
+                called with every event as it is found, in addition to
+                the events being returned by update() and flush()
+
+    Events are (kind, time, value) tuples:
+
+        ('start', start of the first low interval, its mean CCN)
+        ('end', end of the last low interval, mean CCN of the interval
+                that ended the event, NaN if there was no data)
+
+    Intervals start at midnight of the first day of data, like
+    LowCCN.resampled, and an interval is finished once data from a later
+    interval comes in (or on flush()). Records older than the open
+    interval are dropped and counted in 'late'.
+
+    Example:
+
+        monitor = LowCCNMonitor(threshold=20, interval='6H')
+        for frame in NetCDFFolder(folder, pat='aosccn').iter_frames(['CCN', 'SS']):
+            for event in monitor.update(frame):
+                print(event)
+    """
+
+    def __init__(self, threshold=20, interval='6H', supersaturation=0.1,
+                 ccn='CCN', ss='SS', callback=None):
+
+        self.threshold = threshold
+        self.interval = interval
+        self.supersaturation = supersaturation
+        self.ccn = ccn
+        self.ss = ss
+        self.callback = callback
+
+        self._step = pd.Timedelta(interval).value
+        self._origin = None
+        self._bin = None
+        self._sum = 0.
+        self._count = 0
+
+        self.in_event = False
+        self.n_intervals = 0
+        self.n_low = 0
+        self.late = 0
+
+    def _time(self, b):
+        return pd.Timestamp(self._origin + int(b) * self._step)
+
+    def _close(self, means):
+        """Finish intervals self._bin, self._bin + 1, ... with these means"""
+
+        with np.errstate(invalid='ignore'):
+            low = means <= self.threshold
+
+        before = np.concatenate([[self.in_event], low[:-1]])
+        starts = np.nonzero(low & ~before)[0]
+        ends = np.nonzero(~low & before)[0]
+
+        events = [('start', self._time(self._bin + k), means[k]) for k in starts]
+        events += [('end', self._time(self._bin + k), means[k]) for k in ends]
+        events.sort(key=lambda e: e[1])
 
-    def low_ccn_grouper(x, start_times=None, duration=6):
-        """ determines whether a timestamp belongs to the
-            'low' ccn group or the 'all' ccn group.
-            pd.date_range
+        self.in_event = bool(low[-1])
+        self.n_intervals += len(means)
+        self.n_low += int(low.sum())
+
+        if self.callback is not None:
+            for e in events:
+                self.callback(e)
+
+        return events
+
+    def update(self, chunk):
+        """Add a chunk of data (DataFrame with the ccn and ss columns)
+
+        Returns the list of events found in the intervals that this chunk
+        finished.
+        """
+
+        try:
+            data = chunk[self.ccn][chunk[self.ss] == self.supersaturation]
+        except KeyError:
+            raise KeyError('Data Keys Not Found')
+
+        values = data.values.astype(float)
+        ok = ~np.isnan(values)
+        values = values[ok]
+        times = data.index.values.astype('datetime64[ns]').view(np.int64)[ok]
+
+        if not len(values):
+            return []
+
+        if self._origin is None:
+            self._origin = pd.Timestamp(times.min()).normalize().value
+
+        bins = (times - self._origin) // self._step
+
+        if self._bin is None:
+            self._bin = bins.min()
+
+        late = bins < self._bin
+        if late.any():
+            self.late += int(late.sum())
+            bins, values = bins[~late], values[~late]
+            if not len(bins):
+                return []
+
+        rel = bins - self._bin
+        n = int(rel.max()) + 1
+        sums = np.bincount(rel, weights=values, minlength=n)
+        counts = np.bincount(rel, minlength=n)
+        sums[0] += self._sum
+        counts[0] += self._count
+
+        events = []
+        if n > 1:
+            with np.errstate(invalid='ignore', divide='ignore'):
+                events = self._close(sums[:-1] / counts[:-1])
+
+        self._bin += n - 1
+        self._sum = sums[-1]
+        self._count = counts[-1]
+
+        return events
+
+    def flush(self):
+        """Finish the open interval, e.g. at the end of a record
+
+        Returns the events it produced. An event still going on at that
+        point stays open.
         """
-        if (start_times is None) or (duration is None):
-            raise Exception('List of Low CCN Event times and duration not provided')
 
-        if ((x >= start_times) & (x < start_times + delt(hours=duration))).any():
-            return 'Low'
+        if self._bin is None or not self._count:
+            return []
+
+        events = self._close(np.array([self._sum / self._count]))
+
+        self._bin += 1
+        self._sum = 0.
+        self._count = 0
+
+        return events
+
+
+def _interval_aggregates(series, intervals, how='mean'):
+    """Resample a series to several intervals from one set of cumulative sums
+
+    The series is binned once at the greatest common divisor of the
+    intervals, and the sum and count of every interval bin is then the
+    difference of the cumulative sums at its edges. Bins start at
+    midnight of the first day, like pandas resample.
+
+    Returns a list of Series, one per interval, with NaN for empty bins.
+    """
+
+    steps = [pd.Timedelta(i).value for i in intervals]
+    base = np.gcd.reduce(steps)
+
+    values = series.values.astype(float)
+    ok = ~np.isnan(values)
+    times = series.index.values.astype('datetime64[ns]').view(np.int64)[ok]
+    values = values[ok]
+
+    origin = series.index[0].normalize()
+    bins = (times - origin.value) // base
+    nbins = int(bins.max()) + 1 if len(bins) else 0
+
+    csum = np.concatenate([[0.], np.cumsum(np.bincount(bins, weights=values, minlength=nbins))])
+    ccount = np.concatenate([[0], np.cumsum(np.bincount(bins, minlength=nbins))])
+
+    out = []
+    for interval, step in zip(intervals, steps):
+        # from the first to the last interval with data, like resample
+        m = step // base
+        if nbins:
+            edges = np.arange(bins.min() // m * m, (bins.max() // m + 1) * m + 1, m)
+            edges = np.minimum(edges, nbins)
         else:
-            return 'Non-Low'
+            edges = np.zeros(1, dtype=int)
+        sums = csum[edges[1:]] - csum[edges[:-1]]
+        counts = ccount[edges[1:]] - ccount[edges[:-1]]
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            if how == 'mean':
+                agg = sums / counts
+            elif how == 'sum':
+                agg = np.where(counts > 0, sums, np.nan)
+            else:
+                agg = counts.astype(float)
+
+        index = pd.DatetimeIndex(origin + pd.to_timedelta(edges[:-1] * base, unit='ns'))
+        out.append(pd.Series(agg, index=index))
+
+    return out
+
+
+def low_ccn_sweep(ccn_data, thresholds, intervals=('6H',), supersaturations=(0.1,),
+                  how='mean', ccn='CCN', ss='SS'):
+    """Low-CCN event statistics for a grid of LowCCN settings
+
+    Does the same thing as making a LowCCN(threshold=..., interval=...,
+    supersaturation=...) for every combination, but each supersaturation
+    is picked out once, all of the intervals come from one set of
+    cumulative sums (see _interval_aggregates), and all of the thresholds
+    are counted at once from the sorted interval values.
+
+    Arguments
+    ---------------------
 
-    grouped = df.groupby(lambda x:
-                         low_ccn_grouper(x,
-                                         start_times=low.low_events.index,
-                                         duration=interval))
+        Required:
+
+        -   ccn_data (DataFrame or CCNPartition): CCN data with a
+                DatetimeIndex, or a partition of it
+
+        -   thresholds (list): CCN thresholds, events are <= threshold
+
+        Optional:
+
+        -   intervals (list): resampling intervals, e.g. ['1H', '6H']
+
+        -   supersaturations (list): supersaturation setpoints
+
+        -   how (str): 'mean', 'sum', or 'count'
+
+        -   ccn, ss (str): names of the CCN and supersaturation columns
+
+    Returns a DataFrame with one row per (supersaturation, interval,
+    threshold) and columns
+        periods:        number of intervals (len(LowCCN.resampled))
+        valid_periods:  intervals with data
+        events:         number of low-CCN events (len(LowCCN.low_events))
+        fraction:       events / valid_periods
+        first_event, last_event: start times of the first and last events
+    """
+
+    if how not in ('mean', 'sum', 'count'):
+        raise ValueError("how must be 'mean', 'sum', or 'count'")
+
+    # a partition makes picking out each setpoint a lookup; for a plain
+    # DataFrame one scan per setpoint is cheaper than sorting the record
+    if isinstance(ccn_data, CCNPartition):
+        partition = ccn_data
+    else:
+        partition = None
+        try:
+            ss_data = ccn_data[ss]
+            ccn_data = ccn_data[ccn]
+        except KeyError:
+            raise KeyError('Data Keys Not Found')
+
+    intervals = list(intervals)
+    thresholds = np.sort(np.asarray(thresholds, dtype=float))
+
+    rows = []
+    for supersat in supersaturations:
+        if partition is None:
+            subset = ccn_data[ss_data == supersat].sort_index()
+        else:
+            subset = partition.get(supersat).sort_index()
+
+        if not len(subset):
+            continue
+
+        for interval, resampled in zip(intervals, _interval_aggregates(subset, intervals, how)):
+
+            valid = resampled.dropna()
+            order = np.argsort(valid.values, kind='mergesort')
+            ranked = valid.values[order]
+            starts = valid.index.values[order]
+
+            # events for every threshold at once, and the earliest/latest
+            # start among the n lowest intervals
+            n_events = np.searchsorted(ranked, thresholds, side='right')
+            if len(starts):
+                first = np.minimum.accumulate(starts)[np.maximum(n_events - 1, 0)]
+                last = np.maximum.accumulate(starts)[np.maximum(n_events - 1, 0)]
+            else:
+                first = last = np.zeros(len(thresholds), dtype='datetime64[ns]')
+
+            nat = n_events == 0
+            first = np.where(nat, np.datetime64('NaT'), first)
+            last = np.where(nat, np.datetime64('NaT'), last)
+
+            rows.append(pd.DataFrame({'supersaturation': supersat,
+                                      'interval': interval,
+                                      'threshold': thresholds,
+                                      'periods': len(resampled),
+                                      'valid_periods': len(valid),
+                                      'events': n_events,
+                                      'fraction': n_events / float(max(len(valid), 1)),
+                                      'first_event': first,
+                                      'last_event': last},
+                                     columns=['supersaturation', 'interval', 'threshold',
+                                              'periods', 'valid_periods', 'events',
+                                              'fraction', 'first_event', 'last_event']))
+
+    if not len(rows):
+        return pd.DataFrame(columns=['supersaturation', 'interval', 'threshold', 'periods',
+                                     'valid_periods', 'events', 'fraction',
+                                     'first_event', 'last_event'])
+
+    return pd.concat(rows, ignore_index=True)
+
+
+def _as_durations(duration, n):
+    """Event durations as a timedelta64[ns] array of length n
+
+    Numbers are taken as hours, anything else goes through
+    pd.to_timedelta (e.g. '6H', timedelta(hours=6), or an array with one
+    duration per event).
+    """
+
+    if not isinstance(duration, str) and np.asarray(duration).dtype.kind in 'iuf':
+        duration = pd.to_timedelta(np.asarray(duration, dtype=float), unit='h')
+    else:
+        duration = pd.to_timedelta(duration)
+
+    return np.broadcast_to(np.asarray(duration, dtype='timedelta64[ns]'), (n,))
+
+
+def event_mask(times, starts, duration=6):
+    """True for each of 'times' that falls inside any event
+
+    An event runs from its start time up to, but not including, start +
+    duration. Events can overlap and have different durations.
+
+    -   times (DatetimeIndex): the times to label
+    -   starts (DatetimeIndex): event start times, in any order
+    -   duration: hours, a timedelta-like, or one of those per event
+
+    The events are sorted once, and the running maximum of their end times
+    tells whether any event that started at or before a time is still
+    going on at that time, so every time is labelled by one searchsorted
+    call instead of being checked against every event.
+    """
+
+    times = np.asarray(pd.DatetimeIndex(times).values)
+    starts = np.asarray(pd.DatetimeIndex(starts).values)
+
+    if not len(starts):
+        return np.zeros(len(times), dtype=bool)
+
+    ends = starts + _as_durations(duration, len(starts))
+
+    order = np.argsort(starts, kind='mergesort')
+    starts = starts[order]
+    latest_end = np.maximum.accumulate(ends[order])
+
+    k = np.searchsorted(starts, times, side='right') - 1
+    inside = k >= 0
+
+    inside[inside] = times[inside] < latest_end[k[inside]]
+
+    return inside
+
+
+def group_events(df, low, interval=6):
+    """Group df into 'Low' and 'Non-Low' CCN periods
+
+    -   df (DataFrame): data with a DatetimeIndex
+    -   low (LowCCN): its low_events give the event start times
+    -   interval: event duration, in hours or as a timedelta-like (see
+            event_mask)
+    """
+
+    mask = event_mask(df.index, low.low_events.index, duration=interval)
+    grouped = df.groupby(np.where(mask, 'Low', 'Non-Low'))
 
     return grouped
 
@@ -137,10 +672,13 @@ def grouped_rose(group, **kwargs):
     deg = kwargs.pop('deg', 'wdir_vec_mean')
     spd = kwargs.pop('spd', 'wspd_vec_mean')
 
+    # both roses use the same bins
+    plan = BinningPlan(wind_levels)
+
     fig, ax = windrose(direction=group.get_group('Non-Low')[deg],
                        speed=group.get_group('Non-Low')[spd],
                        figsize=figsize, normed=True,
-                       bins=wind_levels,
+                       plan=plan,
                        rect=[0.05, 0.1, 0.4, 0.8],
                        legend=False)
     ax.set_title('Non-Low CCN Events', y=1.08)
@@ -148,7 +686,7 @@ def grouped_rose(group, **kwargs):
     fig, bx = windrose(direction=group.get_group('Low')[deg],
                        speed=group.get_group('Low')[spd],
                        fig=fig, normed=True,
-                       bins=wind_levels,
+                       plan=plan,
                        rect=[0.55, 0.1, 0.4, 0.8],
                        legend=False)
     bx.set_title('Low CCN Events', y=1.08)
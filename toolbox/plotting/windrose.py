@@ -20,7 +20,6 @@ from matplotlib.patches import Rectangle, Polygon
 # from matplotlib.ticker import ScalarFormatter, AutoLocator
 # from matplotlib.text import Text, FontProperties
 from matplotlib.projections.polar import PolarAxes
-from numpy.lib.twodim_base import histogram2d
 import matplotlib.pyplot as plt
 from pylab import poly_between
 
@@ -162,19 +161,29 @@ class WindroseAxes(PolarAxes):
         #self.cla()
         null = kwargs.pop('zorder', None)
 
+        #A BinningPlan (and table made with it) can be passed in to skip
+        #rebuilding the bins and the table for every plot
+        plan = kwargs.pop('plan', None)
+        table = kwargs.pop('table', None)
+
         #Init of the bins array if not set
         bins = kwargs.pop('bins', None)
-        if bins is None:
-            bins = np.linspace(np.min(var), np.max(var), 6)
-        if isinstance(bins, int):
-            bins = np.linspace(np.min(var), np.max(var), bins)
-        bins = np.asarray(bins)
-        nbins = len(bins)
-
-        #Number of sectors
         nsector = kwargs.pop('nsector', None)
-        if nsector is None:
-            nsector = 16
+        if plan is None:
+            if bins is None:
+                bins = np.linspace(np.nanmin(var), np.nanmax(var), 6)
+            if isinstance(bins, int):
+                bins = np.linspace(np.nanmin(var), np.nanmax(var), bins)
+
+            #Number of sectors
+            if nsector is None:
+                nsector = 16
+
+            plan = BinningPlan(bins, nsector)
+
+        bins = plan.bins
+        nbins = plan.nbins
+        nsector = plan.nsector
 
         #Sets the colors table based on the colormap or the "colors" argument
         colors = kwargs.pop('colors', None)
@@ -196,8 +205,11 @@ class WindroseAxes(PolarAxes):
         normed = kwargs.pop('normed', False)
         blowto = kwargs.pop('blowto', False)
 
+        if table is None:
+            table = plan.table(dir, var, normed=normed, blowto=blowto)
+
         #Set the global information dictionnary
-        self._info['dir'], self._info['bins'], self._info['table'] = histogram(dir, var, bins, nsector, normed, blowto)
+        self._info['dir'], self._info['bins'], self._info['table'] = plan.dir_edges, plan.var_bins, table
 
         return bins, nbins, nsector, colors, angles, kwargs
 
@@ -229,6 +241,10 @@ class WindroseAxes(PolarAxes):
         in different colors in the order specified.
         * cmap : a cm Colormap instance from matplotlib.cm.
           - if cmap == None and colors == None, a default Colormap is used.
+        * plan : BinningPlan - bins and sectors to use instead of bins and
+        nsector, so they can be shared between plots.
+        * table : 2D array - a table already made with plan (e.g. from
+        plan.tables), dir and var are then not used.
 
         others kwargs : see help(pylab.plot)
 
@@ -281,6 +297,10 @@ class WindroseAxes(PolarAxes):
         in different colors in the order specified.
         * cmap : a cm Colormap instance from matplotlib.cm.
           - if cmap == None and colors == None, a default Colormap is used.
+        * plan : BinningPlan - bins and sectors to use instead of bins and
+        nsector, so they can be shared between plots.
+        * table : 2D array - a table already made with plan (e.g. from
+        plan.tables), dir and var are then not used.
 
         others kwargs : see help(pylab.plot)
 
@@ -331,6 +351,10 @@ class WindroseAxes(PolarAxes):
         in different colors in the order specified.
         * cmap : a cm Colormap instance from matplotlib.cm.
           - if cmap == None and colors == None, a default Colormap is used.
+        * plan : BinningPlan - bins and sectors to use instead of bins and
+        nsector, so they can be shared between plots.
+        * table : 2D array - a table already made with plan (e.g. from
+        plan.tables), dir and var are then not used.
         edgecolor : string - The string color each edge bar will be plotted.
         Default : no edgecolor
         * opening : float - between 0.0 and 1.0, to control the space between
@@ -391,6 +415,10 @@ class WindroseAxes(PolarAxes):
         in different colors in the order specified.
         * cmap : a cm Colormap instance from matplotlib.cm.
           - if cmap == None and colors == None, a default Colormap is used.
+        * plan : BinningPlan - bins and sectors to use instead of bins and
+        nsector, so they can be shared between plots.
+        * table : 2D array - a table already made with plan (e.g. from
+        plan.tables), dir and var are then not used.
         edgecolor : string - The string color each edge bar will be plotted.
         Default : no edgecolor
 
@@ -420,6 +448,107 @@ class WindroseAxes(PolarAxes):
                     self.patches_list.append(patch)
         self._update()
 
+class BinningPlan(object):
+    """
+    Precomputed direction and var bins for windrose tables.
+    Build it once and use it for as many tables (and plots, with the plan
+    and table keyword arguments) as needed.
+    * bins : 1D array - lower edges of the var bins, the last bin is open
+    ended
+    * nsector : integer - number of direction sectors, centred on the north
+
+    The bins are the same as histogram() has always used: sector 0 runs
+    from 360-angle/2 to angle/2 (north), var bins are [bins[i], bins[i+1])
+    with the last one going to inf, and values below bins[0], NaN, or
+    masked are left out.
+    """
+
+    def __init__(self, bins, nsector=16):
+
+        self.bins = np.asarray(bins, dtype=float)
+        self.nbins = len(self.bins)
+        self.nsector = nsector
+        self.angle = 360./nsector
+
+        dir_bins = np.arange(-self.angle/2, 360.+self.angle, self.angle)
+        dir_bins[0] = 0.
+        self.dir_bins = dir_bins
+
+        # lower edge of each sector, starting with north
+        self.dir_edges = [360.-self.angle/2] + dir_bins[1:-2].tolist()
+        self.var_bins = self.bins.tolist() + [np.inf]
+
+    def cells(self, dir, var, blowto=False):
+        """
+        Returns the flat table cell (var bin * nsector + sector) of every
+        value, -1 for values that don't go in the table.
+        """
+
+        dir = np.ma.filled(np.ma.asarray(dir, dtype=float), np.nan) \
+            if np.ma.isMaskedArray(dir) else np.asarray(dir, dtype=float)
+        var = np.ma.filled(np.ma.asarray(var, dtype=float), np.nan) \
+            if np.ma.isMaskedArray(var) else np.asarray(var, dtype=float)
+
+        if len(var) != len(dir):
+            raise ValueError("var and dir must have same length")
+
+        if blowto:
+            dir = dir + 180.
+            dir[dir >= 360.] -= 360.
+
+        with np.errstate(invalid='ignore'):
+            ok = (dir >= 0.) & (dir <= self.dir_bins[-1]) & (var >= self.bins[0])
+
+        # the top edge of both histograms is closed
+        sector = np.searchsorted(self.dir_bins, dir, side='right') - 1
+        sector[dir == self.dir_bins[-1]] = len(self.dir_bins) - 2
+        sector[sector == self.nsector] = 0
+
+        vbin = np.minimum(np.searchsorted(self.bins, var, side='right') - 1, self.nbins - 1)
+
+        cell = vbin * self.nsector + sector
+        cell[~ok] = -1
+
+        return cell
+
+    def table(self, dir, var, normed=False, blowto=False):
+        """
+        Returns the (nbins x nsector) windrose table for one series.
+        * normed : boolean - The resulting table is normed in percent or not.
+        * blowto : boolean - use the direction the wind blows to
+        """
+
+        return self.tables(dir, var, None, normed=normed, blowto=blowto)[1][0]
+
+    def tables(self, dir, var, by, normed=False, blowto=False):
+        """
+        Returns (keys, tables) with one windrose table per group, all from
+        a single bincount.
+        * by : 1D array - group label of every value, e.g. the month. None
+        puts everything in one group.
+        tables is (ngroups x nbins x nsector), in the order of keys.
+        """
+
+        cell = self.cells(dir, var, blowto=blowto)
+        ncell = self.nbins * self.nsector
+
+        if by is None:
+            keys, group = [None], np.zeros(len(cell), dtype=np.intp)
+        else:
+            keys, group = np.unique(np.asarray(by), return_inverse=True)
+            group = group.ravel()
+
+        ok = cell >= 0
+        counts = np.bincount(group[ok] * ncell + cell[ok], minlength=len(keys) * ncell)
+        tables = counts.reshape(len(keys), self.nbins, self.nsector).astype(float)
+
+        if normed:
+            with np.errstate(invalid='ignore', divide='ignore'):
+                tables *= 100 / tables.sum(axis=(1, 2), keepdims=True)
+
+        return keys, tables
+
+
 def histogram(dir, var, bins, nsector, normed=False, blowto=False):
     """
     Returns an array where, for each sector of wind
@@ -435,36 +564,12 @@ def histogram(dir, var, bins, nsector, normed=False, blowto=False):
     as wind blows from. If true, the table will be reversed (usefull for
     pollutantrose)
 
+    Use a BinningPlan directly to reuse the bins for several tables.
     """
 
-    if len(var) != len(dir):
-        raise ValueError, "var and dir must have same length"
-
-    angle = 360./nsector
-
-    dir_bins = np.arange(-angle/2 ,360.+angle, angle, dtype=np.float)
-    dir_edges = dir_bins.tolist()
-    dir_edges.pop(-1)
-    dir_edges[0] = dir_edges.pop(-1)
-    dir_bins[0] = 0.
-
-    var_bins = bins.tolist()
-    var_bins.append(np.inf)
-
-    if blowto:
-        dir = dir + 180.
-        dir[dir>=360.] = dir[dir>=360.] - 360
-
-    table = histogram2d(x=var, y=dir, bins=[var_bins, dir_bins],
-                          normed=False)[0]
-    # add the last value to the first to have the table of North winds
-    table[:,0] = table[:,0] + table[:,-1]
-    # and remove the last col
-    table = table[:, :-1]
-    if normed:
-        table = table*100/table.sum()
+    plan = BinningPlan(bins, nsector)
 
-    return dir_edges, var_bins, table
+    return plan.dir_edges, plan.var_bins, plan.table(dir, var, normed=normed, blowto=blowto)
 
 
 def wrcontour(dir, var, **kwargs):
@@ -2,8 +2,11 @@ __author__ = 'Jayson Stemmler'
 __created__ = "5/14/15 3:37 PM"
 
 import numpy as np
+import pandas as pd
 import sys
-from math import atan2
+from collections import deque
+from multiprocessing import Pool, cpu_count
+from multiprocessing.pool import ThreadPool
 
 
 class ProgressBar(object):
@@ -46,6 +49,81 @@ class ProgressBar(object):
         sys.stdout.flush()
         del self
 
+def pmap(func, iterable, workers=None, executor=None, window=None):
+    """Lazily map a function over an iterable, optionally in a worker pool
+
+    Results are always yielded in the same order as the inputs.
+
+    -   workers (int)
+            number of pool workers. If both workers and executor are
+            None the map runs serially in this process.
+
+    -   executor (str or pool)
+            'process' (the default when workers is set) or 'thread'. You
+            can also pass an existing multiprocessing pool or
+            concurrent.futures executor, in which case you are in charge
+            of shutting it down. With 'process' the function and its
+            arguments must be picklable, i.e. defined at module level.
+            Processes are the default because netCDF4/HDF5 (what most of
+            the toolbox reads with) isn't safe to call from threads.
+
+    -   window (int)
+            most tasks handed to the pool ahead of the consumer, so that
+            a slow consumer doesn't pile up results in memory. Default
+            is twice the number of workers.
+    """
+
+    if workers is None and executor is None:
+        return (func(i) for i in iterable)
+
+    if window is None:
+        window = 2 * (workers or cpu_count())
+
+    if executor is None or executor == 'process':
+        return _pool_imap(Pool(workers), func, iterable, window)
+    elif executor == 'thread':
+        return _pool_imap(ThreadPool(workers), func, iterable, window)
+    elif hasattr(executor, 'apply_async') or hasattr(executor, 'submit'):
+        return _bounded_imap(executor, func, iterable, window)
+    elif hasattr(executor, 'imap'):
+        return executor.imap(func, iterable)
+    elif hasattr(executor, 'map'):
+        return executor.map(func, iterable)
+    else:
+        raise TypeError("executor must be 'process', 'thread', or a pool object")
+
+def _bounded_imap(pool, func, iterable, window):
+    """Ordered imap with at most 'window' tasks in flight
+
+    Works with multiprocessing pools (apply_async) and concurrent.futures
+    executors (submit).
+    """
+
+    pending = deque()
+
+    for i in iterable:
+        if hasattr(pool, 'apply_async'):
+            pending.append(pool.apply_async(func, (i,)))
+        else:
+            pending.append(pool.submit(func, i))
+
+        if len(pending) >= window:
+            yield _task_result(pending.popleft())
+
+    while pending:
+        yield _task_result(pending.popleft())
+
+def _task_result(task):
+    return task.get() if hasattr(task, 'get') else task.result()
+
+def _pool_imap(pool, func, iterable, window):
+    try:
+        for r in _bounded_imap(pool, func, iterable, window):
+            yield r
+    finally:
+        pool.terminate()
+        pool.join()
+
 def percentile(n):
     def percentile_(x):
         return np.percentile(x, n)
@@ -53,21 +131,28 @@ def percentile(n):
     return percentile_
 
 def uv2deg(u, v):
+    """Convert u, v wind components to meteorological direction (degrees)
 
-    def uv2d(u, v):
-        d = 270 - (atan2(v, u) * (180/np.pi))
-        if d >= 360:
-            d -= 360
-        if u == 0 and v == 0:
-            d = 0
-        return d
+    Direction is where the wind blows from, in [0, 360), and calm winds
+    (u == v == 0) come out as 0. Works on scalars, lists, NumPy arrays,
+    masked arrays and pandas Series (the index is kept).
+    """
 
-    if isinstance(u, float) and isinstance(v, float):
-        deg = uv2d(u, v)
-    else:
-        if len(u) != len(v):
-            raise TypeError('U and V must be same length')
-        deg = np.array([uv2d(ui, vi) for ui, vi in zip(u, v)])
+    if isinstance(u, (list, tuple)):
+        u = np.asarray(u, dtype=float)
+    if isinstance(v, (list, tuple)):
+        v = np.asarray(v, dtype=float)
+
+    if np.ndim(u) and np.ndim(v) and len(u) != len(v):
+        raise TypeError('U and V must be same length')
+
+    deg = np.mod(270 - np.degrees(np.arctan2(v, u)), 360.)
+
+    if not np.ndim(deg):
+        return 0. if (u == 0 and v == 0) or deg >= 360. else float(deg)
+
+    # np.mod can round tiny negative angles up to exactly 360
+    deg[((u == 0) & (v == 0)) | (deg >= 360.)] = 0.
 
     return deg
 
@@ -98,3 +183,60 @@ def met2uv(wspd=None, wdir=None):
     v = -wspd * np.sin(polar_dir_rad)
 
     return u, v
+
+def resample_wind(speed, direction, rule):
+    """Vector-average wind speed and direction into time bins
+
+    Breaks the wind into u/v components and direction unit vectors, sums
+    everything per bin in one grouped pass, and converts back.
+
+    -   speed, direction (pd.Series)
+            wind speed (any unit) and meteorological direction (degrees
+            the wind blows from) on the same DatetimeIndex
+    -   rule (str)
+            pandas offset alias for the bins, e.g. '1H' or '6H'
+
+    Returns a DataFrame with one row per bin:
+
+    -   wspd_vec_mean: magnitude of the mean wind vector
+    -   wdir_vec_mean: direction of the mean wind vector
+    -   wspd_mean:     scalar mean of the wind speed
+    -   wdir_std:      Yamartino (1984) standard deviation of direction
+    -   count:         number of samples with both speed and direction
+    """
+
+    if not speed.index.equals(direction.index):
+        raise ValueError('speed and direction must be on the same index')
+
+    spd = np.asarray(speed, dtype=float)
+    rad = np.radians(np.asarray(direction, dtype=float))
+
+    valid = np.isfinite(spd) & np.isfinite(rad)
+    spd = np.where(valid, spd, 0.)
+    rad = np.where(valid, rad, 0.)
+
+    sin, cos = np.sin(rad), np.cos(rad)
+
+    parts = pd.DataFrame({'u': -spd * sin,
+                          'v': -spd * cos,
+                          'sin': sin * valid,
+                          'cos': cos * valid,
+                          'spd': spd,
+                          'count': valid.astype(float)}, index=speed.index)
+
+    sums = parts.groupby(pd.Grouper(freq=rule)).sum()
+
+    n = sums['count'].where(sums['count'] > 0)
+    u, v = sums['u'] / n, sums['v'] / n
+    sa, ca = sums['sin'] / n, sums['cos'] / n
+
+    eps = np.sqrt(np.clip(1. - (sa**2 + ca**2), 0., 1.))
+
+    out = pd.DataFrame(index=sums.index)
+    out['wspd_vec_mean'] = uv2spd(u, v)
+    out['wdir_vec_mean'] = uv2deg(u, v).where(n.notnull())
+    out['wspd_mean'] = sums['spd'] / n
+    out['wdir_std'] = np.degrees(np.arcsin(eps) * (1 + (2 / np.sqrt(3) - 1) * eps**3))
+    out['count'] = sums['count'].astype(int)
+
+    return out